@@ -12,19 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import io
+import json
+import shutil
 import signal
 import sys
 from types import FrameType
 import os
+import tempfile
 import threading
-from queue import Queue
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Queue, Empty
 #from datetime import datetime
 
+from batchjob import BatchJob
+from jobstore import JobStore, MemoryJobStore, SqliteJobStore
 from kbb import Kbb
+from kbbsession import KbbSession
+from kbbcache import MakeCatalog, CatalogCache, VinCache
+from metrics import formatMetric
+from ratelimiter import RateLimiter
+from resolutionstore import ResolutionStore
 from vehicledatareader import VehicleDataReader
 
 
-from flask import Flask, request
+from flask import Flask, Response, request
 
 from utils.logging import logger
 
@@ -38,51 +52,224 @@ if not "kbb_api_key" in os.environ:
         env = yaml.load(y, Loader=yaml.FullLoader)
         os.environ["kbb_api_key"] = env['kbb_api_key']
 
-#GLOBAL VARIABLES
-dataReader = VehicleDataReader()
-records = {}
-count: int
-matchedCount: int
-errorsCount: int
-noTrimMatch: int
-totalCalls: int
-reporting = False
-pricing = True
-threadLock = threading.Lock()
-limit = float("inf")
-remainingCalls = float("inf")
-threads: int
+#KBB API base url, point it at a local fakekbb.py server to run without a key or quota
+Kbb.KBB_API_ENDPOINT = os.environ.get("KBB_API_ENDPOINT", Kbb.KBB_API_ENDPOINT)
+
+#Connect/read timeouts for the shared KBB connection pool
+Kbb.session.setTimeouts(float(os.environ.get("KBB_CONNECT_TIMEOUT", KbbSession.DEFAULT_CONNECT_TIMEOUT)),
+                        float(os.environ.get("KBB_READ_TIMEOUT", KbbSession.DEFAULT_READ_TIMEOUT)))
+
+#Requests per second and burst allowed across every thread
+Kbb.rateLimiter.configure(float(os.environ.get("KBB_RATE_LIMIT", RateLimiter.DEFAULT_RATE)),
+                          float(os.environ.get("KBB_RATE_BURST", RateLimiter.DEFAULT_BURST)))
+
+#How long KBB catalog lookups are reused before being downloaded again
+Kbb.makeCatalog.ttl = float(os.environ.get("KBB_MAKES_TTL", MakeCatalog.DEFAULT_TTL))
+for catalog in (Kbb.modelCatalog, Kbb.trimCatalog):
+    catalog.ttl = float(os.environ.get("KBB_CATALOG_TTL", CatalogCache.DEFAULT_TTL))
+    catalog.maxSize = int(os.environ.get("KBB_CATALOG_SIZE", CatalogCache.DEFAULT_MAX_SIZE))
+Kbb.optionsCache.ttl = float(os.environ.get("KBB_OPTIONS_TTL", CatalogCache.DEFAULT_TTL))
+
+#Valuations are reused until KBB refreshes its values, daily by default
+Kbb.valueCache.ttl = float(os.environ.get("KBB_VALUES_TTL", CatalogCache.DEFAULT_TTL))
+Kbb.valueCache.maxSize = int(os.environ.get("KBB_VALUES_SIZE", 10 * CatalogCache.DEFAULT_MAX_SIZE))
+
+#Local SQLite file VIN decodes are kept in across runs, and across restarts when it's on a mounted volume
+Kbb.vinCache = VinCache(os.environ.get("KBB_VIN_CACHE_PATH", VinCache.DEFAULT_PATH))
+
+#Local SQLite file resolved vehicles are kept in, so pricing them again only calls vehicle/values.
+#Like the VIN cache it only outlives the container when it's on a mounted volume.
+Kbb.resolutionStore = ResolutionStore(os.environ.get("KBB_RESOLUTION_STORE_PATH", ResolutionStore.DEFAULT_PATH),
+                                      float(os.environ.get("KBB_RESOLUTION_TTL", ResolutionStore.DEFAULT_TTL)))
+
+#Worker threads shared by every request, a request can use up to its threads parameter of them
+MAX_WORKERS = int(os.environ.get("KBB_MAX_WORKERS", 32))
+workerPool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="worker")
+#Every worker and trim pricing thread can hold its own keep-alive connection, sized once as the pool is swapped when it grows
+Kbb.session.setPoolSize(MAX_WORKERS + Kbb.KBB_TRIM_WORKERS)
+#Set on shutdown so workers finish the vehicle they're on and stop picking up new ones
+draining = threading.Event()
+
+#Where jobs submitted to /jobs keep their progress and results, "memory" keeps them in this instance only.
+#Jobs can only be resumed after a restart when this is on a mounted volume.
+JOB_STORE = os.environ.get("KBB_JOB_STORE", SqliteJobStore.DEFAULT_PATH)
+jobStore = MemoryJobStore() if JOB_STORE == "memory" else SqliteJobStore(JOB_STORE)
+
+def warnIfNotPersistent(setting, path):
+    #The temp dir goes away with the container (on Cloud Run it's in memory and per instance)
+    if path and os.path.realpath(path).startswith(os.path.realpath(tempfile.gettempdir()) + os.sep):
+        logger.warning(f"{setting} is {path}, in the temp dir, it will be lost when the container stops. Point it at a mounted volume to keep it.")
+        return True
+    return False
+
+warnIfNotPersistent("KBB_VIN_CACHE_PATH", Kbb.vinCache.path)
+warnIfNotPersistent("KBB_RESOLUTION_STORE_PATH", Kbb.resolutionStore.path)
+if JOB_STORE != "memory":
+    warnIfNotPersistent("KBB_JOB_STORE", JOB_STORE)
+#Bytes of an uploaded CSV kept in memory while its vehicles are valued, the rest is spooled to disk
+CSV_SPOOL_SIZE = int(os.environ.get("KBB_CSV_SPOOL_SIZE", 8 * 1024 * 1024))
+#Vehicles a CSV is read ahead by, a vehicle's option rows must come within this many vehicles of its first row
+CSV_WINDOW = int(os.environ.get("KBB_CSV_WINDOW", VehicleDataReader.CSV_WINDOW))
+
+JOB_PAGE_SIZE = 100 #Vehicles per page of job results by default
+JOB_MAX_PAGE_SIZE = 1000
+#Jobs being valued by this instance, a job key can't be resumed while it's still running
+activeJobs = set()
+activeJobsLock = threading.Lock()
+#Batches being valued by this instance, for the queue depth in /metrics
+activeBatches = set()
+activeBatchesLock = threading.Lock()
 
 #MAIN FUNCTION
 @app.route("/", methods=["POST"])
 def run() -> str:
-    global limit
-    global pricing
-    global reporting
-    global records
-    global validation
-    global remainingCalls
-    global threads
-    global date
-
-    global count
-    global errorsCount
-    global matchedCount
-    global noTrimMatch
-    global totalCalls
-
-    global work
-
-    #Reset variables
-    records = {}
-    count = 0
-    matchedCount = 0
-    errorsCount = 0
-    totalCalls = 0
-    noTrimMatch = 0
-
-    vehicleCount = 0
+    #stream used to send each vehicle as an NDJSON line as soon as it is valued, followed by a summary line
+    stream = request.args.get('stream', default = "N", type = str)
+    #jobKey used to checkpoint every valued vehicle, resubmitting the batch with the same key skips the ones already done
+    jobKey = request.args.get('jobKey', default = None, type = str)
+
+    if draining.is_set():
+        return refuseWhileDraining()
+    batch = readBatch()
+    resumedKeys = set()
+    if jobKey:
+        resumedKeys = checkpointJob(batch, jobKey)
+        if resumedKeys is None:
+            return {"errors": ["Job " + jobKey + " is already running."]}, 409
+    if stream == 'Y':
+        batch.completed = Queue()
+    #----Value Vehicles-------------------------------
+
+    workers = startWork(batch)
 
+    if stream == 'Y':
+        if jobKey:
+            closeJobWhenDone(batch, workers)
+        return Response(streamResults(batch, workers, resumedKeys), mimetype="application/x-ndjson")
+
+    #Wait for threads to finish
+    wait(workers)
+
+    batch.warnLateOptions()
+    ret = getSummary(batch)
+    if jobKey:
+        closeJob(batch)
+        #Vehicles valued by earlier runs of the job are returned along with this run's
+        ret["vehicles"] = jobStore.getResults(jobKey, 0, batch.vehicleCount)
+    else:
+        ret["vehicles"] = batch.records
+
+    return ret
+
+#JOB API
+@app.route("/jobs", methods=["POST"])
+def submitJob():
+    #Same parameters and body as POST /, but returns right away and values the vehicles in the background.
+    #Submitting with a jobKey resumes that job, skipping the vehicles it already finished.
+    jobKey = request.args.get('jobKey', default = uuid.uuid4().hex, type = str)
+    if draining.is_set():
+        return refuseWhileDraining()
+    batch = readBatch()
+    if checkpointJob(batch, jobKey) is None:
+        return {"errors": ["Job " + jobKey + " is already running."]}, 409
+
+    workers = startWork(batch)
+    closeJobWhenDone(batch, workers)
+
+    return {"jobId": batch.jobId, "status": JobStore.RUNNING}, 202
+
+@app.route("/jobs/<jobId>", methods=["GET"])
+def getJob(jobId):
+    job = jobStore.getJob(jobId)
+    if job is None:
+        return {"errors": ["Job " + jobId + " not found."]}, 404
+    return job
+
+@app.route("/jobs/<jobId>/results", methods=["GET"])
+def getJobResults(jobId):
+    #page starts at 1, vehicles are returned in the order they finished
+    page = max(request.args.get('page', default = 1, type = int), 1)
+    pageSize = min(max(request.args.get('pageSize', default = JOB_PAGE_SIZE, type = int), 1), JOB_MAX_PAGE_SIZE)
+    job = jobStore.getJob(jobId)
+    if job is None:
+        return {"errors": ["Job " + jobId + " not found."]}, 404
+    vehicles = jobStore.getResults(jobId, (page - 1) * pageSize, pageSize)
+    return {"jobId": jobId, "status": job["status"], "page": page, "pageSize": pageSize, "vehicles": vehicles}
+
+#METRICS
+@app.route("/metrics", methods=["GET"])
+def getMetrics():
+    #Prometheus text format, KBB call and vehicle timings plus the state of the caches, pool and batches
+    with activeBatchesLock:
+        batches = list(activeBatches)
+    caches = Kbb.getCacheStats()
+    coalesced = Kbb.singleFlight.getStats()["byEndpoint"]
+    rateLimit = Kbb.rateLimiter.getStats()
+    connections = Kbb.session.getStats()
+    text = (Kbb.metrics.render()
+            + formatMetric("kbb_queued_vehicles", "gauge", "Vehicles read but not started yet.", [("kbb_queued_vehicles", {}, sum(batch.getQueued() for batch in batches))])
+            + formatMetric("kbb_active_batches", "gauge", "Batches being valued.", [("kbb_active_batches", {}, len(batches))])
+            + formatMetric("kbb_worker_threads", "gauge", "Size of the worker pool.", [("kbb_worker_threads", {}, MAX_WORKERS)])
+            + formatMetric("kbb_worker_utilization", "gauge", "Fraction of the worker pool running a batch.", [("kbb_worker_utilization", {}, Kbb.metrics.busyWorkers / MAX_WORKERS)])
+            + formatMetric("kbb_cache_hits_total", "counter", "Cache lookups answered from the cache.", [("kbb_cache_hits_total", {"cache": name}, stats["hits"]) for name, stats in caches.items()])
+            + formatMetric("kbb_cache_misses_total", "counter", "Cache lookups that had to be fetched or computed.", [("kbb_cache_misses_total", {"cache": name}, stats["misses"]) for name, stats in caches.items()])
+            + formatMetric("kbb_cache_hit_ratio", "gauge", "Hits over lookups since the process started.", [("kbb_cache_hit_ratio", {"cache": name}, stats["hitRate"]) for name, stats in caches.items()])
+            + formatMetric("kbb_cache_entries", "gauge", "Entries held by the cache.", [("kbb_cache_entries", {"cache": name}, stats["size"]) for name, stats in caches.items()])
+            + formatMetric("kbb_coalesced_calls_total", "counter", "KBB calls shared with an identical call already in flight.", [("kbb_coalesced_calls_total", {"endpoint": endpoint}, saved) for endpoint, saved in sorted(coalesced.items())])
+            + formatMetric("kbb_rate_limit", "gauge", "KBB calls per second currently allowed.", [("kbb_rate_limit", {}, rateLimit["rate"])])
+            + formatMetric("kbb_http_requests_total", "counter", "HTTP requests sent on the pooled KBB session.", [("kbb_http_requests_total", {}, connections["requests"])])
+            + formatMetric("kbb_connections_opened_total", "counter", "Connections opened to the KBB API.", [("kbb_connections_opened_total", {}, connections["connectionsOpened"])]))
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+def refuseWhileDraining():
+    #The instance is shutting down, the batch has to be sent to another one
+    return {"errors": ["Shutting down, submit the batch again."]}, 503
+
+def checkpointJob(batch, jobId):
+    #Save each vehicle to the job store as it finishes. Returns the keys an earlier run already
+    #finished, or None if the job is still running here.
+    with activeJobsLock:
+        if jobId in activeJobs:
+            return None
+        activeJobs.add(jobId)
+    batch.store = jobStore
+    batch.jobId = jobId
+    resumedKeys = jobStore.getResultKeys(jobId)
+    batch.resume(resumedKeys, (vehicle for key, vehicle in iterResults(jobId)))
+    jobStore.createJob(jobId, batch.getSummary())
+    return resumedKeys
+
+def iterResults(jobId):
+    #Every vehicle the job store has for the job, read a page at a time
+    offset = 0
+    while True:
+        page = jobStore.getResults(jobId, offset, JOB_MAX_PAGE_SIZE)
+        if not page:
+            return
+        offset += len(page)
+        yield from page.items()
+
+def closeJob(batch):
+    #A job cut short by a shutdown, with vehicles deferred by its call budget or with vehicles KBB was
+    #throttling or failing on is left stopped so it can be resumed
+    status = JobStore.DONE if batch.isFinished() and not batch.deferred and not batch.failedTemporarily else JobStore.STOPPED
+    jobStore.finishJob(batch.jobId, getSummary(batch), status)
+    with activeJobsLock:
+        activeJobs.discard(batch.jobId)
+
+def closeJobWhenDone(batch, workers):
+    remaining = [len(workers)]
+    lock = threading.Lock()
+    def workerDone(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        closeJob(batch)
+    for future in workers:
+        future.add_done_callback(workerDone)
+
+def readBatch():
     #limit used to cap the max number of calls
     limit = request.args.get('limit', default=float("inf"), type = float)
     #report used to flag whether or not to generate a detailed report
@@ -99,9 +286,28 @@ def run() -> str:
     #mode 3: VIN, YMM, mileage, trim
     #mode 4: VIN, YMM mileage, trim, options
     validation = request.args.get('validation', default = 3, type = int)
+    #mileageBucket used to share cached valuations between mileages rounded to this many miles
+    mileageBucket = request.args.get('mileageBucket', default = 0, type = int)
+    #engine used to value vehicles on OS threads (threads) or on a single asyncio event loop (async)
+    engine = request.args.get('engine', default = "threads", type = str)
+    #concurrency used to cap how many vehicles the async engine keeps in flight
+    concurrency = request.args.get('concurrency', default = 100, type = int)
+    #group used to resolve the KBB vehicle once for vehicles sharing a VIN squish or year/make/model and trim
+    group = request.args.get('group', default = "Y", type = str)
+    #refresh used to force KBB catalogs to be downloaded again
+    refresh = request.args.get('refresh', default = "N", type = str)
+    #metrics used to add this batch's KBB call latencies, retries and vehicle timings to the summary
+    metrics = request.args.get('metrics', default = "N", type = str)
+    #budget used to cap the KBB calls the batch makes, vehicles that could run out of calls partway are deferred, 0 is no cap
+    budget = request.args.get('budget', default = 0, type = int)
+    #resolve used to find every vehicle's KBB vehicle and options again instead of reusing the stored ones
+    resolve = request.args.get('resolve', default = "N", type = str)
 
     dataReader = VehicleDataReader(validation, limit)
 
+    if refresh == 'Y':
+        Kbb.refreshCatalogs()
+
     pricing = True if prices == 'Y' else False
 
     reporting = True if report == 'Y' else False
@@ -110,99 +316,172 @@ def run() -> str:
         data = request.get_json()
         records = dataReader.jsonInput(data)
     else:
-        csv = request.get_data().decode()
-        records = dataReader.csvInput(str(csv))
-
-    vehicleCount = len(records.keys())
-    #----Value Vehicles-------------------------------
-
-    for record in records.values():
-        work.put(record)
-    
-    for i in range(threads):
-        thread = threading.Thread(target=worker)
-        thread.daemon = True
-        thread.start()
-    
-    #Wait for threads to finish
-    work.join()
-
-    ret = {"vehicleCount": vehicleCount, "processed": count, "priced": matchedCount, "errors": errorsCount, "totalCallsMade": totalCalls, "remainingCalls": remainingCalls, "usedLowestPricedTrim":noTrimMatch, "vehicles": records}
-
-    return ret
-
-work = Queue()
-
-def worker():
-    while True:
-        vehicle = work.get()
+        #Copy the upload aside so vehicles can be read from it a few rows at a time after this request
+        #returns (POST /jobs). Only the first CSV_SPOOL_SIZE bytes are kept in memory, the rest go to disk.
+        body = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_SIZE)
+        shutil.copyfileobj(request.stream, body)
+        body.seek(0)
+        records = readCsv(dataReader, body)
+
+    return BatchJob(records, reporting, pricing, mileageBucket, engine, threads, concurrency, group == 'Y', metrics == 'Y', budget, resolve == 'Y', dataReader)
+
+def readCsv(dataReader, body):
+    with body:
+        yield from dataReader.csvStream(io.TextIOWrapper(body, encoding="utf-8", newline=""), CSV_WINDOW)
+
+def startWork(batch):
+    if batch.engine == 'async':
+        workers = [workerPool.submit(asyncio.run, asyncWork(batch, batch.concurrency))]
+    else:
+        workers = [workerPool.submit(worker, batch) for i in range(min(batch.threads, MAX_WORKERS))]
+    with activeBatchesLock:
+        activeBatches.add(batch)
+    def workerDone(future):
+        if all(worker.done() for worker in workers):
+            with activeBatchesLock:
+                activeBatches.discard(batch)
+    for future in workers:
+        future.add_done_callback(workerDone)
+    return workers
+
+def getSummary(batch):
+    summary = batch.getSummary()
+    summary.update({"connectionStats": Kbb.session.getStats(), "rateLimit": Kbb.rateLimiter.getStats(), "cacheStats": Kbb.getCacheStats(), "coalescedCalls": Kbb.singleFlight.getStats()})
+    if batch.resolutions is not None:
+        summary["groupStats"] = batch.resolutions.getStats()
+    if batch.budget is not None:
+        summary["callBudget"] = batch.budget.getStats()
+        summary["deferredVehicles"] = list(batch.deferred)
+    if batch.metrics is not Kbb.metrics:
+        summary["metrics"] = batch.metrics.getSummary()
+    return summary
+
+def streamResults(batch, workers, resumedKeys=()):
+    #Vehicles an earlier run of the job finished go out first, straight from the job store
+    if resumedKeys:
+        for key, vehicle in iterResults(batch.jobId):
+            if key in resumedKeys:
+                yield json.dumps(vehicle) + "\n"
+    streamed = 0
+    #vehicleCount keeps growing while the CSV is still being read
+    while not (batch.fed and streamed >= batch.vehicleCount - batch.resumed):
         try:
-            job(vehicle)
-        except Exception as e:
-            print(e)
-        work.task_done()
+            key = batch.completed.get(timeout=1)
+        except Empty:
+            #Workers stopped early (shutdown), don't wait on vehicles that will never finish
+            if all(worker.done() for worker in workers):
+                break
+            continue
+        streamed += 1
+        #Drop the vehicle once it's sent so memory stays flat however big the batch is
+        vehicle = batch.records.pop(key, None)
+        if vehicle is not None:
+            yield json.dumps(vehicle) + "\n"
+    yield json.dumps(getSummary(batch)) + "\n"
+
+def worker(batch):
+    with Kbb.metrics.working():
+        while not draining.is_set():
+            vehicle = batch.nextRecord()
+            if vehicle is None:
+                return
+            try:
+                with batch.metrics.valuing(batch.engine):
+                    job(batch, vehicle)
+            except Exception as e:
+                print(e)
+            finally:
+                batch.vehicleDone(vehicle)
 
 #THREADED JOB
-def job(record):
-    global records
-    global threadLock
-    global reporting
-    global validation
-    global date
-    
-    global count
-    global errorsCount
-    global matchedCount
-    global noTrimMatch
-    global totalCalls
-
-    kbb = Kbb(os.environ["kbb_api_key"], reporting)
-    errors = []
+def job(batch, record):
+    kbb = Kbb(os.environ["kbb_api_key"], batch.reporting, batch.mileageBucket)
+    kbb.resolutions = batch.resolutions
+    kbb.forceResolve = batch.forceResolve
+    kbb.metrics = batch.metrics
     report = {}
-    # if float(errorsCount) > float(count) * 0.2: #If there is more than 20% error stop trying
-    #     return
-    with threadLock:
-        count+=1
+    batch.startVehicle()
     try:
         #print("--BEGIN VEHICLE------")
         #print(record)
-        if dataReader.ERRORS in record:
-            raise Exception(str(record[dataReader.ERRORS]))
-        report = kbb.getVehicleValue(record.get(dataReader.ID), record.get(dataReader.VIN), record.get(dataReader.YEAR), record.get(dataReader.MAKE), record.get(dataReader.MODEL), record.get(dataReader.TRIM),  record.get(dataReader.MILEAGE), "96819", record.get(dataReader.OPTIONS, set()))#, date)
-        records[record.get(dataReader.ID)]["report"] = {}
-        if "prices" in report and report["prices"]:
-            with threadLock:
-                matchedCount+=1
-            prices = report.pop("prices")
-            if pricing:
-                records[record.get(dataReader.ID)]["prices"] = prices
-        if "usedLowestPricedTrim" in report and report["usedLowestPricedTrim"]:
-            with threadLock:
-                noTrimMatch+=1
-        if "numCallsMade" in report:
-            with threadLock:
-                totalCalls+=report["numCallsMade"]
-        records[record.get(dataReader.ID)]["report"] = report
+        batch.checkRecord(record)
+        if batch.budget is not None:
+            kbb.budget = batch.admitVehicle(record)
+            if kbb.budget is None:
+                return
+        report = kbb.getVehicleValue(*batch.getVehicleValueArgs(record))#, date)
+        batch.saveReport(record, report)
         #print("--END VEHICLE------")
     except Exception as e:
         report = {"errors": [str(e)]}
-    if "errors" in report:
-        errors = errors + report.pop("errors")
-        if len(errors) > 0:
-            with threadLock:
-                errorsCount+=len(errors)
-            records[record.get(dataReader.ID)]["errors"] = errors
-    updateRemainingCalls(kbb.rateLimit)
-
-def updateRemainingCalls(remaining):
-    global remainingCalls
-    with threadLock:
-        if remaining < remainingCalls:
-            remainingCalls = remaining
+        kbb.noteError(e)
+    finally:
+        if kbb.budget:
+            kbb.budget.release()
+    batch.finishVehicle(record, report, kbb.rateLimit, kbb.failedTemporarily)
+
+#ASYNC JOB
+async def asyncJob(batch, record, session):
+    from asynckbb import AsyncKbb
+
+    kbb = AsyncKbb(os.environ["kbb_api_key"], session, batch.reporting, batch.mileageBucket)
+    kbb.resolutions = batch.resolutions
+    kbb.forceResolve = batch.forceResolve
+    kbb.metrics = batch.metrics
+    report = {}
+    batch.startVehicle()
+    try:
+        batch.checkRecord(record)
+        if batch.budget is not None:
+            kbb.budget = await batch.admitVehicleAsync(record)
+            if kbb.budget is None:
+                return
+        report = await kbb.getVehicleValue(*batch.getVehicleValueArgs(record))
+        batch.saveReport(record, report)
+    except Exception as e:
+        report = {"errors": [str(e)]}
+        kbb.noteError(e)
+    finally:
+        if kbb.budget:
+            kbb.budget.release()
+    batch.finishVehicle(record, report, kbb.rateLimit, kbb.failedTemporarily)
+
+async def asyncWork(batch, concurrency):
+    from asynckbb import createSession
+
+    inFlight = asyncio.Semaphore(concurrency)
+    with Kbb.metrics.working():
+        async with createSession(concurrency) as session:
+            async def valueVehicle(record):
+                try:
+                    with batch.metrics.valuing(batch.engine):
+                        await asyncJob(batch, record, session)
+                finally:
+                    if batch.store is not None:
+                        #Checkpointing writes to the job store, keep it off the event loop
+                        await asyncio.to_thread(batch.vehicleDone, record)
+                    else:
+                        batch.vehicleDone(record)
+                    inFlight.release()
+            #Only read the next vehicle once there's room for it, so a big CSV isn't all read up front
+            tasks = set()
+            while not draining.is_set():
+                await inFlight.acquire()
+                record = batch.nextRecord()
+                if record is None:
+                    break
+                task = asyncio.ensure_future(valueVehicle(record))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
 
 def shutdown_handler(signal_int: int, frame: FrameType) -> None:
     logger.info(f"Caught Signal {signal.strsignal(signal_int)}")
 
+    #Let the workers finish the vehicles they're valuing before exiting
+    draining.set()
+    workerPool.shutdown(wait=True)
+
     from utils.logging import flush
 
     flush()
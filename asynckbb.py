@@ -0,0 +1,93 @@
+import asyncio
+import json
+from time import monotonic
+
+import aiohttp
+
+from kbb import Kbb
+
+def createSession(poolSize, connectTimeout=None, readTimeout=None):
+    #Has to be created and closed inside the event loop that uses it
+    connectTimeout = Kbb.session.connectTimeout if connectTimeout is None else connectTimeout
+    readTimeout = Kbb.session.readTimeout if readTimeout is None else readTimeout
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=poolSize),
+                                 timeout=aiohttp.ClientTimeout(sock_connect=connectTimeout, sock_read=readTimeout))
+
+class AsyncKbb(Kbb):
+    #Runs Kbb's valuation flows with every KBB call awaited on an aiohttp session, so one event loop
+    #can keep hundreds of vehicles in flight. Only running the flow steps is overridden, the flows,
+    #matching and reporting are inherited from Kbb unchanged.
+
+    def __init__(self, api_key, session, report = False, mileageBucket = 0) -> None:
+        super().__init__(api_key, report, mileageBucket)
+        self.session = session
+
+    def isTemporaryError(self, e):
+        return super().isTemporaryError(e) or isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    async def run(self, flow):
+        result, error = None, None
+        while True:
+            try:
+                step = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = await self.runStep(*step), None
+            except Exception as e:
+                result, error = None, e
+
+    async def runStep(self, kind, *args):
+        if kind == self.CALL:
+            return await self.sendRequest(*args)
+        if kind == self.CACHED:
+            cache, method, key, flow = args
+            return await getattr(cache, method + "Async")(key, lambda: self.run(flow()))
+        if kind == self.PARALLEL:
+            return await self.runParallel(args[0])
+        if kind == self.BLOCKING:
+            #SQLite reads and writes would stall every other vehicle on the event loop
+            return await asyncio.to_thread(*args)
+        raise ValueError("Unknown flow step: " + str(kind))
+
+    async def runParallel(self, flows):
+        tasks = [asyncio.ensure_future(self.run(flow())) for flow in flows]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except Exception:
+            #Stop running the remaining flows, one failing fails them all
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def sendRequest(self, requestType, url, params, data, retries=99):
+        key = self.getRequestKey(requestType, url, params, data)
+        if self.budget:
+            self.budget.spend()
+        response, shared = await self.singleFlight.doAsync(key, self.getEndpointName(url), lambda: self.fetchResponse(requestType, url, params, data, retries))
+        if shared and self.budget:
+            self.budget.refund()
+        return self.readSharedResponse(*response) if shared else self.readResponse(*response[:3])
+
+    async def fetchResponse(self, requestType, url, params, data, retries=99):
+        if retries > self.KBB_MAX_RETRIES:
+            retries = self.KBB_MAX_RETRIES
+        method = "POST" if requestType == "POST" else "GET"
+        endpoint = self.getEndpointName(url)
+        while True:
+            wait = self.rateLimiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            started = monotonic()
+            try:
+                async with self.session.request(method, self.KBB_API_ENDPOINT + url, params=params, json=data if method == "POST" else None) as ret:
+                    content = await ret.read()
+            except Exception:
+                self.metrics.observeCall(endpoint, "error", monotonic() - started)
+                raise
+            self.metrics.observeCall(endpoint, ret.status, monotonic() - started)
+            if self.shouldRetry(ret.status, ret.headers, retries):
+                self.metrics.countRetry(endpoint, ret.status)
+                retries -= 1
+                continue
+            return ret.status, json.loads(content), content, ret.headers
@@ -0,0 +1,241 @@
+import threading
+from time import monotonic
+
+from callbudget import CallBudget
+from kbb import Kbb
+from kbbcache import CatalogCache
+from metrics import Metrics
+from vehicledatareader import VehicleDataReader
+
+class BatchJob:
+    #Everything one POST needs while its vehicles are valued, so overlapping batches don't share state
+    DEFAULT_ZIP = "96819"
+    GROUPS_SIZE = 4096 #Resolved vehicle groups kept per batch, the least recently used resolve again
+
+    def __init__(self, records, reporting = False, pricing = True, mileageBucket = 0, engine = "threads", threads = 5, concurrency = 100, grouping = True, metrics = False, callBudget = 0, forceResolve = False, reader = None) -> None:
+        #records is either a dict of vehicles by key or an iterator of (key, vehicle) pairs
+        #that is read a vehicle at a time as workers become free
+        self.reading = not isinstance(records, dict)
+        self.records = {} if self.reading else records
+        self.feed = records if self.reading else None
+        self.feedLock = threading.Lock()
+        self.fed = False #Set once every vehicle has been handed to a worker
+        self.doneKeys = set()
+        self.vehicleCount = 0 if self.reading else len(records)
+        self.completed = None #Queue of finished vehicle keys when results are streamed
+        self.store = None #JobStore finished vehicles are saved to when submitted to /jobs
+        self.jobId = None
+        self.engine = engine
+        self.threads = threads
+        self.concurrency = concurrency
+        #Vehicles sharing a VIN squish or year/make/model and trim reuse the first one's KBB vehicle
+        self.resolutions = CatalogCache(ttl=float("inf"), maxSize=self.GROUPS_SIZE) if grouping else None
+        #metrics keeps this batch's KBB call latencies apart for its response, they're still counted process wide
+        self.metrics = Metrics(Kbb.metrics) if metrics else Kbb.metrics
+        self.started = monotonic()
+        #callBudget caps the KBB calls the batch makes, vehicles it can't cover are deferred rather than valued
+        self.budget = CallBudget(callBudget) if callBudget else None
+        self.deferred = [] #Keys of the vehicles left for a later run
+        self.failedTemporarily = set() #Keys of vehicles KBB throttled or failed on, a resumed job values them again
+        self.forceResolve = forceResolve #Resolve every vehicle again instead of using Kbb.resolutionStore
+        self.reader = reader #VehicleDataReader the records come from, for the CSV option rows it had to drop
+        self.reporting = reporting
+        self.pricing = pricing
+        self.mileageBucket = mileageBucket
+        self.lock = threading.Lock()
+        self.count = 0
+        self.matchedCount = 0
+        self.errorsCount = 0
+        self.noTrimMatch = 0
+        self.totalCalls = 0
+        self.remainingCalls = float("inf")
+        self.resumed = 0
+        self.resolvedFromStore = 0
+
+    def resume(self, doneKeys, doneVehicles=()):
+        #Leave out vehicles an earlier run of the same job already finished, they count as processed
+        #and their prices, errors and calls are counted again from the saved vehicles
+        self.doneKeys = doneKeys
+        for key in list(self.records):
+            if str(key) in doneKeys:
+                del self.records[key]
+                self.resumed += 1
+        self.count = self.resumed
+        for vehicle in doneVehicles:
+            self.countDoneVehicle(vehicle)
+
+    def countDoneVehicle(self, vehicle):
+        report = vehicle.get("report") or {}
+        errors = vehicle.get("errors") or []
+        #Without prices=Y a saved vehicle has no prices to look at, one that got a report without errors was priced
+        if vehicle.get("prices") or (not self.pricing and "report" in vehicle and not errors):
+            self.matchedCount += 1
+        if report.get("usedLowestPricedTrim"):
+            self.noTrimMatch += 1
+        if report.get("resolvedFromStore"):
+            self.resolvedFromStore += 1
+        self.totalCalls += report.get("numCallsMade", 0)
+        self.errorsCount += len(errors)
+
+    def nextRecord(self):
+        #The next vehicle to value, or None once there are none left
+        with self.feedLock:
+            if self.feed is None:
+                self.feed = iter(self.plan())
+            for key, record in self.feed:
+                if self.reading:
+                    with self.lock:
+                        self.vehicleCount += 1
+                        if str(key) in self.doneKeys:
+                            self.resumed += 1
+                            self.count += 1
+                            continue
+                    self.records[key] = record
+                self.metrics.observeQueueWait(self.engine, monotonic() - self.started)
+                return record
+            self.fed = True
+            return None
+
+    def getGroupKey(self, record):
+        vin = record.get(VehicleDataReader.VIN)
+        if vin:
+            return (Kbb.squishVin(vin), record.get(VehicleDataReader.TRIM))
+        return (record.get(VehicleDataReader.YEAR), record.get(VehicleDataReader.MAKE), record.get(VehicleDataReader.MODEL), record.get(VehicleDataReader.TRIM))
+
+    def plan(self):
+        #The first vehicle of every group goes first so free workers resolve other groups
+        #instead of waiting on a group whose KBB vehicle is still being resolved
+        records = list(self.records.items())
+        if self.resolutions is None:
+            return records
+        leaders = []
+        followers = []
+        groups = set()
+        for key, record in records:
+            group = self.getGroupKey(record)
+            if group in groups:
+                followers.append((key, record))
+            else:
+                groups.add(group)
+                leaders.append((key, record))
+        return leaders + followers
+
+    def getQueued(self):
+        #Vehicles read but not started yet, a CSV that is still being read only counts the rows read so far
+        with self.lock:
+            return self.vehicleCount - self.count
+
+    def isFinished(self):
+        with self.lock:
+            return self.fed and self.count >= self.vehicleCount
+
+    def startVehicle(self):
+        # if float(self.errorsCount) > float(self.count) * 0.2: #If there is more than 20% error stop trying
+        #     return
+        with self.lock:
+            self.count+=1
+
+    def admitVehicle(self, record):
+        #Hold the vehicle's estimated calls, None once the budget can't cover it
+        hold = self.budget.admit(self.getCostKind(record))
+        if hold is None:
+            self.deferVehicle(record)
+        return hold
+
+    async def admitVehicleAsync(self, record):
+        hold = await self.budget.admitAsync(self.getCostKind(record))
+        if hold is None:
+            self.deferVehicle(record)
+        return hold
+
+    def getCostKind(self, record):
+        return "vin" if record.get(VehicleDataReader.VIN) else "name"
+
+    def deferVehicle(self, record):
+        record["deferred"] = True
+        with self.lock:
+            self.deferred.append(record.get(VehicleDataReader.ID))
+
+    def checkRecord(self, record):
+        if VehicleDataReader.ERRORS in record:
+            raise Exception(str(record[VehicleDataReader.ERRORS]))
+
+    def getVehicleValueArgs(self, record):
+        return (record.get(VehicleDataReader.ID), record.get(VehicleDataReader.VIN), record.get(VehicleDataReader.YEAR), record.get(VehicleDataReader.MAKE), record.get(VehicleDataReader.MODEL), record.get(VehicleDataReader.TRIM), record.get(VehicleDataReader.MILEAGE), self.DEFAULT_ZIP, record.get(VehicleDataReader.OPTIONS, set()))
+
+    def saveReport(self, record, report):
+        vehicle = self.records[record.get(VehicleDataReader.ID)]
+        vehicle["report"] = {}
+        if "prices" in report and report["prices"]:
+            with self.lock:
+                self.matchedCount+=1
+            prices = report.pop("prices")
+            if self.pricing:
+                vehicle["prices"] = prices
+        if "usedLowestPricedTrim" in report and report["usedLowestPricedTrim"]:
+            with self.lock:
+                self.noTrimMatch+=1
+        if report.get("resolvedFromStore"):
+            with self.lock:
+                self.resolvedFromStore+=1
+        if "numCallsMade" in report:
+            with self.lock:
+                self.totalCalls+=report["numCallsMade"]
+        vehicle["report"] = report
+
+    def finishVehicle(self, record, report, rateLimit, failedTemporarily=False):
+        errors = []
+        if "errors" in report:
+            errors = errors + report.pop("errors")
+            if len(errors) > 0:
+                with self.lock:
+                    self.errorsCount+=len(errors)
+                    if failedTemporarily:
+                        self.failedTemporarily.add(record.get(VehicleDataReader.ID))
+                self.records[record.get(VehicleDataReader.ID)]["errors"] = errors
+        self.updateRemainingCalls(rateLimit)
+
+    def warnLateOptions(self, key=None):
+        #Warn vehicles still held here about option rows that came after csvStream had handed them out,
+        #a vehicle already streamed or checkpointed is only counted in droppedOptionRows
+        if self.reader is None:
+            return
+        for late in list(self.reader.lateOptions) if key is None else [key]:
+            options = self.reader.lateOptions.get(late)
+            vehicle = self.records.get(late)
+            if options and vehicle is not None:
+                vehicle["warnings"] = ["Options " + ", ".join(options) + " were left out, their CSV rows came after the vehicle had been read. "
+                                       + "Keep a vehicle's rows together or raise KBB_CSV_WINDOW."]
+
+    def vehicleDone(self, record):
+        key = record.get(VehicleDataReader.ID)
+        self.warnLateOptions(key)
+        if self.store is not None and key in self.records and not record.get("deferred") and key not in self.failedTemporarily:
+            #Checkpoint the vehicle as soon as it's done so a restarted job doesn't value it again,
+            #a vehicle that only failed because KBB was throttling or down is left for the restart to retry
+            self.store.saveResult(self.jobId, key, self.records[key], self.getSummary())
+        if self.completed is not None:
+            self.completed.put(key)
+        elif self.store is not None:
+            #The store keeps the vehicle from here on, so the batch doesn't hold every result in memory
+            self.records.pop(key, None)
+
+    def updateRemainingCalls(self, remaining):
+        with self.lock:
+            if remaining < self.remainingCalls:
+                self.remainingCalls = remaining
+
+    def getSummary(self):
+        with self.lock:
+            return {"vehicleCount": self.vehicleCount,
+                    "processed": self.count - len(self.deferred), #Deferred vehicles are started but never valued
+                    "priced": self.matchedCount,
+                    "errors": self.errorsCount,
+                    "totalCallsMade": self.totalCalls,
+                    "remainingCalls": self.remainingCalls,
+                    "usedLowestPricedTrim": self.noTrimMatch,
+                    "resumed": self.resumed,
+                    "deferred": len(self.deferred),
+                    "failedTemporarily": len(self.failedTemporarily),
+                    "resolvedFromStore": self.resolvedFromStore,
+                    "droppedOptionRows": self.reader.droppedOptionRows if self.reader is not None else 0}
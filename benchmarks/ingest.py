@@ -0,0 +1,62 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# CSV ingest throughput with and without the fast validation path.
+# Run from the repository root: python -m benchmarks.ingest --rows 100000
+
+import argparse
+import io
+from time import perf_counter
+
+from vehicledatareader import VehicleDataReader
+
+HEADER = "ID,VIN,Year,MakeName,ModelName,BodyStyle,OptionsDescription,Mileage"
+OPTIONS = ["Moonroof", "JBL Audio", "Navi System"]
+
+
+def makeCsv(rows: int, invalidEvery: int) -> str:
+    lines = [HEADER]
+    for i in range(rows):
+        vehicle = i // len(OPTIONS)
+        mileage = "" if invalidEvery and vehicle % invalidEvery == 0 else '"4%d,000"' % (vehicle % 10)
+        lines.append('%d,VIN%08d,2019,Toyota,Tacoma,SR5 PKUP,%s,%s' % (vehicle, vehicle, OPTIONS[i % len(OPTIONS)], mileage))
+    return "\n".join(lines)
+
+
+def measure(csvData: str, validation: int, fastValidation: bool) -> float:
+    reader = VehicleDataReader(validation, fastValidation=fastValidation)
+    start = perf_counter()
+    for vehicle in reader.csvStream(io.StringIO(csvData)):
+        pass
+    return perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--invalid-every", type=int, default=20, help="Every nth vehicle is missing its mileage, 0 for none")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    csvData = makeCsv(args.rows, args.invalid_every)
+    for validation in (1, 2, 3, 4):
+        results = {}
+        for fastValidation in (False, True):
+            seconds = min(measure(csvData, validation, fastValidation) for i in range(args.repeat))
+            results[fastValidation] = args.rows / seconds
+        print("validation %d: pydantic %9.0f rows/s  fast %9.0f rows/s  (%.1fx)" % (validation, results[False], results[True], results[True] / results[False]))
+
+
+if __name__ == "__main__":
+    main()
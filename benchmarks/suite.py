@@ -0,0 +1,225 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Ingest, matching and end-to-end valuation benchmarks, written as JSON so runs can be compared.
+# Every KBB call goes to a local fakekbb.py server, no API key or quota is used.
+# Run from the repository root: python -m benchmarks.suite --baseline benchmarks/results/<earlier run>.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+#app reads its settings when imported, keep the benchmark off the real API, VIN, resolution and job files
+os.environ.setdefault("kbb_api_key", "benchmark")
+os.environ.setdefault("KBB_VIN_CACHE_PATH", "")
+os.environ.setdefault("KBB_RESOLUTION_STORE_PATH", "")
+os.environ.setdefault("KBB_JOB_STORE", "memory")
+
+from benchmarks.ingest import makeCsv
+from fakekbb import FakeKbb
+from kbb import Kbb
+from kbbcache import VinCache
+from resolutionstore import ResolutionStore
+from singleflight import SingleFlight
+from vehicledatareader import VehicleDataReader
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+DEALER_OPTIONS = ["Moonroof", "JBL Audio", "Navi System", "Premium Package", "Leather", "Heated Seat", "Tow Pkg", "Blind Spot Monitor"]
+DEALER_TRIMS = ["SR5 PKUP", "TRD OFF RD 4X4", "LIMITED DBL CAB", "SR ACCESS CAB", "LE SEDAN", "XLE AWD"]
+MODELS = ["Tacoma", "Corolla", "Camry", "RAV4", "Highlander", "Tundra"]
+
+
+def measure(run: Callable[[], None], repeat: int) -> List[float]:
+    seconds = []
+    for i in range(repeat):
+        start = perf_counter()
+        run()
+        seconds.append(perf_counter() - start)
+    return seconds
+
+
+def result(name: str, unit: str, count: int, seconds: List[float], **params) -> Dict:
+    #value is the median rate, higher is better for every benchmark
+    return {"name": name,
+            "unit": unit,
+            "value": round(count / statistics.median(seconds), 2),
+            "best": round(count / min(seconds), 2),
+            "seconds": [round(second, 4) for second in seconds],
+            "params": params}
+
+
+def makeVehicles(count: int) -> List[Dict]:
+    #Half by VIN, half by year/make/model. Every VIN squish is shared by a few vehicles like a dealer's lot
+    vehicles = []
+    for i in range(count):
+        vehicle = {"key": str(i), "year": 2015 + i % 8, "make": "Toyota", "model": MODELS[i % len(MODELS)],
+                   "trim": DEALER_TRIMS[i % len(DEALER_TRIMS)], "mileage": 20000 + i * 750 % 90000,
+                   "options": DEALER_OPTIONS[i % 3:i % 3 + 3]}
+        if i % 2 == 0:
+            vehicle["vin"] = "5TFCZ5AN%dK%07d" % (i // 2 % 9, i)
+        vehicles.append(vehicle)
+    return vehicles
+
+
+def benchIngest(rows: int, repeat: int) -> List[Dict]:
+    csvData = makeCsv(rows, 20)
+    jsonData = {"vehicles": makeVehicles(rows)}
+    #jsonInput writes the key and validation mode into each row, which doesn't change its speed
+    return [result("ingest.csvInput", "rows/s", rows, measure(lambda: VehicleDataReader(3).csvInput(csvData), repeat), rows=rows),
+            result("ingest.jsonInput", "rows/s", rows, measure(lambda: VehicleDataReader(3).jsonInput(jsonData), repeat), rows=rows)]
+
+
+def benchMatching(vehicles: int, repeat: int) -> List[Dict]:
+    fake = FakeKbb()
+    kbb = Kbb("benchmark")
+    records = makeVehicles(vehicles)
+    #Every vehicle gets its own copy of its KBB options, matching cleans them in place
+    catalogs = [[fake.getOptions(1000 + i % 50) for i in range(vehicles)] for run in range(repeat)]
+
+    def convertTrims():
+        for record in records:
+            kbb.startVehicle(record["key"], record["model"], record["trim"])
+
+    def matchOptions(catalog):
+        for record, options in zip(records, catalog):
+            kbb.startVehicle(record["key"], record["model"], record["trim"])
+            kbb.vehicle = {"vehicleId": options[0]["vehicleOptionId"] // 100, "vehicleOptions": options}
+            kbb.getMatchingVehicleOptionCodes(list(record["options"]))
+
+    trims = measure(convertTrims, repeat)
+    runs = iter(catalogs)
+    matches = measure(lambda: matchOptions(next(runs)), repeat)
+    return [result("matching.convertTrimName", "vehicles/s", vehicles, trims, vehicles=vehicles),
+            result("matching.getMatchingVehicleOptionCodes", "vehicles/s", vehicles, matches, vehicles=vehicles)]
+
+
+def resetKbb() -> None:
+    #Every run starts with nothing cached so thread counts are compared on the same calls
+    Kbb.refreshCatalogs()
+    Kbb.vinCache = VinCache(None)
+    Kbb.resolutionStore = ResolutionStore(None)
+    Kbb.singleFlight = SingleFlight()
+
+
+def benchEndToEnd(vehicles: int, threadCounts: List[int], latency: float, rateLimit: float, repeat: int) -> List[Dict]:
+    from app import app
+
+    fake = FakeKbb(latency=latency)
+    endpoint = Kbb.KBB_API_ENDPOINT
+    rate, burst = Kbb.rateLimiter.rate, Kbb.rateLimiter.burst
+    Kbb.KBB_API_ENDPOINT = fake.start()
+    Kbb.rateLimiter.configure(rateLimit, rateLimit)
+    client = app.test_client()
+    body = {"vehicles": makeVehicles(vehicles)}
+    results = []
+    try:
+        for threads in threadCounts:
+            summaries = []
+
+            def run():
+                resetKbb()
+                response = client.post("/?validation=1&threads=%d" % threads, json=body)
+                summaries.append(response.get_json())
+
+            seconds = measure(run, repeat)
+            summary = summaries[-1]
+            results.append(result("endToEnd.post", "vehicles/s", vehicles, seconds, vehicles=vehicles, threads=threads,
+                                  latency=latency, rateLimit=rateLimit, priced=summary["priced"],
+                                  errors=summary["errors"], callsMade=summary["totalCallsMade"]))
+    finally:
+        fake.stop()
+        Kbb.KBB_API_ENDPOINT = endpoint
+        Kbb.rateLimiter.configure(rate, burst)
+    return results
+
+
+def getRevision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float) -> List[str]:
+    #Benchmarks that got slower than the baseline by more than tolerance, matched on name and params
+    earlier = {(entry["name"], json.dumps(entry["params"], sort_keys=True)): entry["value"] for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        value = earlier.get((entry["name"], json.dumps(entry["params"], sort_keys=True)))
+        if not value:
+            continue
+        change = entry["value"] / value - 1
+        print("%-45s %10.1f -> %10.1f %s (%+.1f%%)" % (entry["name"], value, entry["value"], entry["unit"], change * 100))
+        if change < -tolerance:
+            regressions.append(entry["name"])
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000, help="Rows read by the ingest benchmarks")
+    parser.add_argument("--vehicles", type=int, default=2000, help="Vehicles matched by the matching benchmarks")
+    parser.add_argument("--batch", type=int, default=200, help="Vehicles posted by the end-to-end benchmark")
+    parser.add_argument("--threads", default="1,5,20", help="Comma separated thread counts for the end-to-end benchmark")
+    parser.add_argument("--latency", type=float, default=20, help="Milliseconds the fake KBB server takes to answer")
+    parser.add_argument("--rate-limit", type=float, default=1000, help="KBB calls per second the app is allowed")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", choices=["ingest", "matching", "endToEnd"], action="append", help="Run just these benchmarks")
+    parser.add_argument("--output", help="Where the JSON results go, a new file in benchmarks/results by default")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Slowdown from the baseline reported as a regression")
+    args = parser.parse_args()
+
+    only = args.only or ["ingest", "matching", "endToEnd"]
+    results = []
+    if "ingest" in only:
+        results += benchIngest(args.rows, args.repeat)
+    if "matching" in only:
+        results += benchMatching(args.vehicles, args.repeat)
+    if "endToEnd" in only:
+        threadCounts = [int(threads) for threads in args.threads.split(",")]
+        results += benchEndToEnd(args.batch, threadCounts, args.latency / 1000, args.rate_limit, args.repeat)
+    for entry in results:
+        params = ", ".join("%s=%s" % item for item in entry["params"].items())
+        print("%-45s %10.1f %-11s %s" % (entry["name"], entry["value"], entry["unit"], params))
+
+    created = datetime.now()
+    run = {"created": created.isoformat(timespec="seconds"),
+           "revision": getRevision(),
+           "python": platform.python_version(),
+           "platform": platform.platform(),
+           "results": results}
+    output = args.output or os.path.join(RESULTS_DIR, created.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(run, f, indent=1)
+    print("Results written to " + output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Slower than the baseline: " + ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
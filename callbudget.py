@@ -0,0 +1,121 @@
+import asyncio
+import threading
+
+class BudgetUsedUpError(Exception):
+    #The batch ran out of calls partway through a vehicle, it can be valued by a later run
+    pass
+
+class CallBudget:
+    #KBB calls a batch may make. Every vehicle holds its estimated cost before it starts and spends
+    #from the hold as it calls KBB, so vehicles are only started when the budget can see them through.
+    #Vehicles that can't be covered are deferred instead of dying halfway with their calls spent.
+    DEFAULT_ESTIMATE = 15 #Calls held per vehicle until one of its kind has finished and shown what they cost
+    WAIT = 0.05 #Seconds the async engine waits between admission checks
+
+    def __init__(self, calls, estimate=DEFAULT_ESTIMATE) -> None:
+        self.calls = calls
+        self.condition = threading.Condition()
+        self.spent = 0
+        self.held = 0 #Calls held by vehicles in flight and not spent yet
+        self.holds = 0 #Vehicles in flight
+        self.defaultEstimate = estimate
+        self.costliest = {} #kind -> most calls a finished vehicle of that kind has made
+
+    def getFree(self):
+        return self.calls - self.spent - self.held
+
+    def getEstimate(self, kind):
+        #Calls held for a vehicle, the most a finished vehicle of the same kind (looked up by VIN or by name) made
+        return max(self.costliest.get(kind, min(self.defaultEstimate, self.calls)), 1)
+
+    def getSpare(self):
+        #Calls left unheld while other vehicles are in flight, for one that makes more calls than it held
+        return max(self.costliest.values(), default=0) if self.holds else 0
+
+    def tryAdmit(self, kind):
+        #Returns (hold, wait), wait is True when vehicles in flight might hand back enough calls
+        with self.condition:
+            estimate = self.getEstimate(kind)
+            if estimate + self.getSpare() <= self.getFree():
+                self.held += estimate
+                self.holds += 1
+                return Hold(self, kind, estimate), False
+            return None, self.holds > 0
+
+    def admit(self, kind):
+        #Hold calls for a vehicle, None if the budget can't cover it
+        with self.condition:
+            while True:
+                hold, wait = self.tryAdmit(kind)
+                if not wait:
+                    return hold
+                self.condition.wait()
+
+    async def admitAsync(self, kind):
+        #Holds are handed back by coroutines on the same event loop, so poll rather than block it
+        while True:
+            hold, wait = self.tryAdmit(kind)
+            if not wait:
+                return hold
+            await asyncio.sleep(self.WAIT)
+
+    def spend(self, hold):
+        #Called before every KBB call, past its hold a vehicle spends calls nobody is holding
+        with self.condition:
+            if hold.calls > 0:
+                hold.calls -= 1
+                self.held -= 1
+            elif self.getFree() <= 0:
+                raise BudgetUsedUpError("The call budget of " + str(self.calls) + " KBB calls is used up.")
+            hold.spent += 1
+            self.spent += 1
+
+    def refund(self, hold):
+        #The call was shared with another vehicle's identical call, so this vehicle didn't make it
+        with self.condition:
+            hold.spent -= 1
+            self.spent -= 1
+            self.condition.notify_all()
+
+    def release(self, hold):
+        #Hand back what the vehicle didn't spend and learn from what it did
+        with self.condition:
+            self.held -= hold.calls
+            hold.calls = 0
+            self.holds -= 1
+            self.costliest[hold.kind] = max(self.costliest.get(hold.kind, 0), hold.spent)
+            self.condition.notify_all()
+
+    def cap(self, remaining):
+        #KBB reported fewer calls left today than this budget has left
+        with self.condition:
+            if self.spent + remaining < self.calls:
+                self.calls = self.spent + int(remaining)
+                self.condition.notify_all()
+
+    def getStats(self):
+        with self.condition:
+            return {"budget": self.calls,
+                    "spent": self.spent,
+                    "held": self.held,
+                    "estimates": {kind: self.getEstimate(kind) for kind in self.costliest}}
+
+class Hold:
+    #The calls one vehicle holds, shared by the threads pricing its trims
+    def __init__(self, budget, kind, calls) -> None:
+        self.budget = budget
+        self.kind = kind
+        self.calls = calls
+        self.spent = 0
+
+    def spend(self):
+        self.budget.spend(self)
+
+    def refund(self):
+        self.budget.refund(self)
+
+    def cap(self, remaining):
+        self.budget.cap(remaining)
+
+    def release(self):
+        self.budget.release(self)
@@ -0,0 +1,240 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+class FakeKbb:
+    #Local stand-in for the KBB idws endpoints Kbb calls, so the app can be run and benchmarked
+    #without an API key or quota. Point KBB_API_ENDPOINT at the url start() returns.
+    #replay: answers from recorded fixtures, made up (but consistent) answers for anything not recorded
+    #record: forwards every call to the real API and saves the answers as fixtures
+    UPSTREAM = "https://api.kbb.com/idws/"
+    DAILY_LIMIT = 25000
+
+    MAKES = ["Toyota", "Honda", "Ford", "Land Rover", "Subaru"]
+    MODELS = ["Tacoma", "Corolla", "Camry", "RAV4", "Highlander", "Tundra"]
+    TRIMS = ["SR Access Cab", "SR5 Double Cab", "TRD Off-Road Double Cab", "Limited Double Cab", "LE Sedan 4D", "XLE Sport Utility 4D"]
+    OPTIONS = ["Premium Pkg", "Moon Roof", "Navigation System", "Blind-Spot Monitor", "4WD", "Leather Seats", "Alloy Wheels",
+               "JBL Premium Audio", "Towing Pkg, Heavy Duty", "Technology Pkg", "Entune Audio", "Heated Seats"]
+
+    def __init__(self, fixtures=None, mode="replay", upstream=UPSTREAM, latency=0, jitter=0, throttle=0,
+                 dailyLimit=DAILY_LIMIT, rateLimit=0, strict=False, seed=0) -> None:
+        self.fixtures = fixtures #Directory fixtures are read from and recorded to, None for made up answers only
+        self.mode = mode
+        self.upstream = upstream
+        self.latency = latency #Seconds added to every answer
+        self.jitter = jitter #Up to this many seconds more or less than latency
+        self.throttle = throttle #Fraction of calls answered with a 429
+        self.rateLimit = rateLimit #Calls per second allowed before answering 429, 0 is unlimited
+        self.strict = strict #Answer 404 instead of making up answers for calls that weren't recorded
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.remainingDay = dailyLimit
+        self.second = 0
+        self.secondCalls = 0
+        self.calls = Counter()
+        self.throttled = 0
+        self.server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True #Headers and body are written separately, don't hold the body for an ACK
+
+            def do_GET(self):
+                self.answer(None)
+
+            def do_POST(self):
+                self.answer(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+            def answer(self, body):
+                status, headers, content = fake.handle(self.command, self.path, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        return "http://%s:%d/idws/" % (host, self.server.server_port)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def handle(self, method, path, body):
+        url = urllib.parse.urlsplit(path)
+        endpoint = url.path.split("/idws/", 1)[-1].strip("/")
+        params = dict(urllib.parse.parse_qsl(url.query))
+        data = json.loads(body) if body else None
+        if self.latency or self.jitter:
+            sleep(max(0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        throttled, headers = self.checkLimits()
+        if throttled:
+            return 429, headers, json.dumps({"message": "Too many requests"}).encode()
+        with self.lock:
+            self.calls[endpoint.split("/vin/")[0] + "/vin" if "/vin/" in endpoint else endpoint] += 1
+
+        if self.mode == "record":
+            status, answer = self.forward(method, url, body)
+            if status == 200:
+                self.saveFixture(method, endpoint, params, data, status, answer)
+            return status, headers, json.dumps(answer).encode()
+        fixture = self.loadFixture(method, endpoint, params, data)
+        if fixture:
+            return fixture["status"], headers, json.dumps(fixture["body"]).encode()
+        if self.strict:
+            return 404, headers, json.dumps({"message": "No fixture recorded for " + endpoint}).encode()
+        status, answer = self.makeAnswer(endpoint, params, data)
+        return status, headers, json.dumps(answer).encode()
+
+    def checkLimits(self):
+        #Returns (throttled, headers) with the X-RateLimit-* headers KBB sends
+        with self.lock:
+            now = int(monotonic())
+            if now != self.second:
+                self.second = now
+                self.secondCalls = 0
+            self.secondCalls += 1
+            throttled = ((self.rateLimit and self.secondCalls > self.rateLimit)
+                         or self.remainingDay <= 0
+                         or (self.throttle and self.random.random() < self.throttle))
+            if throttled:
+                self.throttled += 1
+            else:
+                self.remainingDay -= 1
+            headers = {"X-RateLimit-Remaining-Day": str(self.remainingDay)}
+            if self.rateLimit:
+                headers["X-RateLimit-Limit-Second"] = str(self.rateLimit)
+                headers["X-RateLimit-Remaining-Second"] = str(max(self.rateLimit - self.secondCalls, 0))
+            if throttled:
+                headers["Retry-After"] = "1"
+            return throttled, headers
+
+    def getFixturePath(self, method, endpoint, params, data):
+        params = {name: value for name, value in params.items() if name != "api_key"}
+        request = json.dumps([method, endpoint, sorted(params.items()), data], sort_keys=True)
+        name = endpoint.replace("/", "_") if "/vin/" not in endpoint else "vehicle_vin"
+        return os.path.join(self.fixtures, name + "_" + hashlib.sha1(request.encode()).hexdigest()[:16] + ".json")
+
+    def loadFixture(self, method, endpoint, params, data):
+        if not self.fixtures:
+            return None
+        try:
+            with open(self.getFixturePath(method, endpoint, params, data)) as fixture:
+                return json.load(fixture)
+        except FileNotFoundError:
+            return None
+
+    def saveFixture(self, method, endpoint, params, data, status, answer):
+        if not self.fixtures:
+            return
+        os.makedirs(self.fixtures, exist_ok=True)
+        with open(self.getFixturePath(method, endpoint, params, data), "w") as fixture:
+            json.dump({"status": status, "body": answer}, fixture, indent=1)
+
+    def forward(self, method, url, body):
+        request = urllib.request.Request(self.upstream + url.path.split("/idws/", 1)[-1] + ("?" + url.query if url.query else ""),
+                                         data=body, method=method, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read() or b"{}")
+
+    #Made up catalog, the same inputs always get the same answer
+    def pick(self, choices, *seed):
+        return choices[int(hashlib.sha1(repr(seed).encode()).hexdigest(), 16) % len(choices)]
+
+    def getTrims(self, modelId, year):
+        modelName = self.MODELS[modelId % 100 % len(self.MODELS)]
+        return [{"vehicleId": modelId * 1000 + int(year) % 100 * 10 + index, "modelName": modelName, "trimName": trimName}
+                for index, trimName in enumerate(self.TRIMS[:4] if modelName in ("Tacoma", "Tundra") else self.TRIMS[4:])]
+
+    def getOptions(self, vehicleId):
+        return [{"vehicleOptionId": vehicleId * 100 + index, "optionName": optionName, "isTypical": index % 4 == 0,
+                 "isVinDecoded": False} for index, optionName in enumerate(self.OPTIONS)]
+
+    def makeAnswer(self, endpoint, params, data):
+        if endpoint.startswith("vehicle/vin/id/"):
+            vin = endpoint.rsplit("/", 1)[-1].upper()
+            if len(vin) != 17:
+                return 400, {"message": "Invalid VIN: " + vin}
+            squish = vin[:8] + vin[9]
+            modelId = (self.MAKES.index(self.pick(self.MAKES, squish)) + 1) * 100 + self.MODELS.index(self.pick(self.MODELS, squish))
+            trims = self.getTrims(modelId, 2000 + int(self.pick(range(10, 24), squish)))
+            for trim in trims:
+                trim["vehicleOptions"] = self.getOptions(trim["vehicleId"])
+                trim["vehicleOptions"][1]["isVinDecoded"] = True
+            return 200, {"vinResults": trims}
+        if endpoint == "vehicle/makes":
+            return 200, {"items": [{"makeId": index + 1, "makeName": makeName} for index, makeName in enumerate(self.MAKES)]}
+        if endpoint == "vehicle/models":
+            makeId = int(params.get("makeid", 0))
+            return 200, {"items": [{"modelId": makeId * 100 + index, "modelName": modelName} for index, modelName in enumerate(self.MODELS)]}
+        if endpoint == "vehicle/vehicles":
+            return 200, {"items": self.getTrims(int(params.get("modelId", 0)), params.get("yearId", 2019))}
+        if endpoint == "vehicle/vehicleoptions":
+            return 200, {"items": self.getOptions(int(params.get("vehicleId", 0)))}
+        if endpoint == "vehicle/applyconfiguration":
+            start = data.get("StartingConfiguration", {})
+            optionIds = set(start.get("vehicleOptionIds", [])) | {change["VehicleOptionId"] for change in data.get("ConfigurationChanges", [])}
+            return 200, {"finalConfiguration": {"vehicleId": start.get("VehicleId"), "vehicleOptionIds": sorted(optionIds)}}
+        if endpoint == "vehicle/values":
+            configuration = data["configuration"]
+            optionIds = configuration.get("vehicleOptionIds", [])
+            base = 18000 + int(self.pick(range(0, 20000, 250), configuration["vehicleId"]))
+            value = max(base + 150 * len(optionIds) - int(data.get("mileage") or 0) // 10, 500)
+            optionPrices = [{"vehicleOptionId": str(optionId), "optionPrice": 150} for optionId in optionIds]
+            return 200, {"prices": [{"priceTypeId": 2, "priceTypeDisplay": "Typical Listing Price", "configuredValue": value, "optionPrices": optionPrices},
+                                    {"priceTypeId": 1, "priceTypeDisplay": "Private Party Value", "configuredValue": value - 1200, "optionPrices": optionPrices}]}
+        return 404, {"message": "Unknown endpoint " + endpoint}
+
+    def getStats(self):
+        with self.lock:
+            return {"calls": dict(self.calls),
+                    "throttled": self.throttled,
+                    "remainingDay": self.remainingDay}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the KBB API, run the app with KBB_API_ENDPOINT=http://HOST:PORT/idws/")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--mode", choices=["replay", "record"], default="replay")
+    parser.add_argument("--fixtures", help="Directory fixtures are replayed from or recorded to")
+    parser.add_argument("--upstream", default=FakeKbb.UPSTREAM, help="API calls are forwarded to when recording")
+    parser.add_argument("--latency", type=float, default=0, help="Milliseconds added to every answer")
+    parser.add_argument("--jitter", type=float, default=0, help="Up to this many milliseconds more or less than latency")
+    parser.add_argument("--throttle", type=float, default=0, help="Fraction of calls answered with a 429")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Calls per second before answering 429, 0 is unlimited")
+    parser.add_argument("--daily-limit", type=int, default=FakeKbb.DAILY_LIMIT)
+    parser.add_argument("--strict", action="store_true", help="Answer 404 for calls without a fixture instead of making one up")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakeKbb(args.fixtures, args.mode, args.upstream, args.latency / 1000, args.jitter / 1000, args.throttle,
+                   args.daily_limit, args.rate_limit, args.strict, args.seed)
+    print("KBB_API_ENDPOINT=" + fake.start(args.host, args.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,127 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from time import time
+
+class JobStore(ABC):
+    #Where submitted jobs keep their progress and finished vehicles.
+    #Subclass it to keep jobs somewhere other than this instance.
+    RUNNING = "running"
+    DONE = "done"
+    STOPPED = "stopped" #Shut down before every vehicle was valued, resubmit with the same jobKey to resume
+
+    @abstractmethod
+    def createJob(self, jobId, summary):
+        #Creating a job that already exists starts it running again and keeps its results
+        pass
+
+    @abstractmethod
+    def saveResult(self, jobId, key, vehicle, summary):
+        pass
+
+    @abstractmethod
+    def finishJob(self, jobId, summary, status=DONE):
+        pass
+
+    @abstractmethod
+    def getJob(self, jobId):
+        pass
+
+    @abstractmethod
+    def getResults(self, jobId, offset, limit):
+        pass
+
+    @abstractmethod
+    def getResultKeys(self, jobId):
+        pass
+
+class MemoryJobStore(JobStore):
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.results = {}
+
+    def createJob(self, jobId, summary):
+        with self.lock:
+            now = time()
+            created = self.jobs.get(jobId, {}).get("created", now)
+            self.jobs[jobId] = {"jobId": jobId, "status": self.RUNNING, "created": created, "updated": now, **summary}
+            self.results.setdefault(jobId, {})
+
+    def saveResult(self, jobId, key, vehicle, summary):
+        with self.lock:
+            self.results[jobId][key] = vehicle
+            self.jobs[jobId].update(summary, updated=time())
+
+    def finishJob(self, jobId, summary, status=JobStore.DONE):
+        with self.lock:
+            self.jobs[jobId].update(summary, status=status, updated=time())
+
+    def getJob(self, jobId):
+        with self.lock:
+            job = self.jobs.get(jobId)
+            return dict(job) if job else None
+
+    def getResults(self, jobId, offset, limit):
+        with self.lock:
+            keys = list(self.results.get(jobId, {}))[offset:offset + limit]
+            return {key: self.results[jobId][key] for key in keys}
+
+    def getResultKeys(self, jobId):
+        with self.lock:
+            return set(self.results.get(jobId, {}))
+
+class SqliteJobStore(JobStore):
+    #Jobs can only be resumed after a restart when path is on a mounted volume, the temp dir default goes with the container
+    DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "kbb_jobs.sqlite3")
+
+    def __init__(self, path=DEFAULT_PATH) -> None:
+        self.path = path
+        self.local = threading.local() #sqlite connections can't be shared between threads
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, created REAL NOT NULL, updated REAL NOT NULL, summary TEXT NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS results (job_id TEXT NOT NULL, key TEXT NOT NULL, vehicle TEXT NOT NULL, PRIMARY KEY (job_id, key))")
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def createJob(self, jobId, summary):
+        connection = self.connect()
+        now = time()
+        connection.execute("INSERT INTO jobs (id, status, created, updated, summary) VALUES (?, ?, ?, ?, ?) "
+                           "ON CONFLICT (id) DO UPDATE SET status = excluded.status, updated = excluded.updated, summary = excluded.summary",
+                           (jobId, self.RUNNING, now, now, json.dumps(summary)))
+        connection.commit()
+
+    def saveResult(self, jobId, key, vehicle, summary):
+        connection = self.connect()
+        connection.execute("INSERT OR REPLACE INTO results (job_id, key, vehicle) VALUES (?, ?, ?)", (jobId, str(key), json.dumps(vehicle)))
+        connection.execute("UPDATE jobs SET summary = ?, updated = ? WHERE id = ?", (json.dumps(summary), time(), jobId))
+        connection.commit()
+
+    def finishJob(self, jobId, summary, status=JobStore.DONE):
+        connection = self.connect()
+        connection.execute("UPDATE jobs SET status = ?, summary = ?, updated = ? WHERE id = ?", (status, json.dumps(summary), time(), jobId))
+        connection.commit()
+
+    def getJob(self, jobId):
+        row = self.connect().execute("SELECT status, created, updated, summary FROM jobs WHERE id = ?", (jobId,)).fetchone()
+        if not row:
+            return None
+        return {"jobId": jobId, "status": row[0], "created": row[1], "updated": row[2], **json.loads(row[3])}
+
+    def getResults(self, jobId, offset, limit):
+        rows = self.connect().execute("SELECT key, vehicle FROM results WHERE job_id = ? ORDER BY rowid LIMIT ? OFFSET ?", (jobId, limit, offset)).fetchall()
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def getResultKeys(self, jobId):
+        rows = self.connect().execute("SELECT key FROM results WHERE job_id = ?", (jobId,)).fetchall()
+        return {row[0] for row in rows}
@@ -1,6 +1,22 @@
+import copy
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 import requests
-from datetime import datetime, timedelta
-from time import sleep
+from callbudget import BudgetUsedUpError
+from kbbsession import KbbSession
+from metrics import Metrics
+from ratelimiter import RateLimiter
+from kbbcache import MakeCatalog, CatalogCache, OptionsCache, VinCache
+from namenormalizer import NameNormalizer
+from optionindex import OptionIndex
+from singleflight import SingleFlight
+
+class KbbUnavailableError(Exception):
+    #KBB throttled the call or failed to answer it, valuing the vehicle again later can succeed
+    pass
 
 class Kbb:
     #KBB Settings
@@ -14,11 +30,38 @@ class Kbb:
     KBB_VEHICLE_CONFIG_ENDPOINT = "vehicle/applyconfiguration"
     KBB_VEHICLE_LIMIT = 500 #500 is the max limit to send to KBB
     KBB_SUCCESS_LOG_MESSAGE = "KBB API call made!"
-    KBB_TIME_WAIT = 0 #Seconds to wait between calls
-    KBB_RETRY_WAIT = 1 #Seconds to wait before retrying a call
     KBB_MAX_RETRIES = 60 #Number of retries before failing a vehicle pricing
+    KBB_TRIM_WORKERS = 16 #Threads shared by every vehicle for pricing trims at the same time
+    KBB_LOWEST_TRIM_STOP_PRICE = 0 #Stop pricing trims for the lowest priced one once a wave has one at or below this, 0 prices them all
+    KBB_LOWEST_TRIM_WAVE = KBB_TRIM_WORKERS #Trims priced at once while KBB_LOWEST_TRIM_STOP_PRICE is set
     DEFAULT_ZIP = "96819" #Default zip code for kbb pricing
 
+    #Steps a valuation flow yields to the engine running it, see run
+    CALL = "call" #(CALL, requestType, url, params, data[, retries]) -> the KBB response
+    CACHED = "cached" #(CACHED, cache, method, key, flow) -> cache.method(key, ...) with flow() run on a miss
+    PARALLEL = "parallel" #(PARALLEL, flows) -> every flow() run at once, results in order
+    BLOCKING = "blocking" #(BLOCKING, function, *args) -> function(*args), kept off the event loop by AsyncKbb
+
+    #Pooled keep-alive connections shared by every Kbb instance in the process
+    session = KbbSession()
+    #Paces the calls of every Kbb instance in the process to stay under KBB's per second limit
+    rateLimiter = RateLimiter()
+    #Identical KBB calls made at the same time by different vehicles share one response
+    singleFlight = SingleFlight()
+    #KBB call latencies, retries and 429s of every Kbb instance in the process, a batch can set its own on the instance
+    metrics = Metrics()
+    #Prices the candidate trims of every vehicle that falls back to the lowest priced trim
+    trimExecutor = ThreadPoolExecutor(max_workers=KBB_TRIM_WORKERS)
+    #KBB catalogs shared by every Kbb instance in the process
+    makeCatalog = MakeCatalog()
+    modelCatalog = CatalogCache() #(year, makeId) -> vehicle/models response
+    trimCatalog = CatalogCache() #(modelId, year) -> vehicle/vehicles response
+    vinCache = VinCache() #VIN -> vinResults, persisted to a local SQLite file
+    resolutionStore = None #ResolutionStore resolved vehicles are kept in between runs, None resolves every vehicle
+    optionsCache = OptionsCache() #vehicleId -> vehicle/vehicleoptions items
+    optionIndexCache = CatalogCache() #(vehicleId, cleaned option names) -> OptionIndex
+    valueCache = CatalogCache() #(vehicleId, optionIds, mileage, zip) -> vehicle/values response
+
     #Convert Servco trim names -> KBB trim names
     TRIM_CONVERSION = {
         "PKUP": "Pickup",
@@ -100,13 +143,16 @@ class Kbb:
         "Starlink"
     ]
 
-    def __init__(self, api_key, report = False) -> None:
+    #The name tables above compiled into lookups, build a new one after changing them
+    names = NameNormalizer(TRIM_CONVERSION, TRIM_IGNORE, OPTION_CONVERSION, OPTION_IGNORE, OPTION_REMOVE)
+
+    def __init__(self, api_key, report = False, mileageBucket = 0) -> None:
         self.api_key = api_key
+        self.lock = threading.Lock() #Guards the counters updated by trim pricing threads
         self.resetRequest()
         self.id = 0
         self.vehicle = {}
         #self.valuationDate = ""
-        self.lastRequestTime = datetime.now() - timedelta(seconds=1)
         self.trims = {}
         self.values = {}
         self.servcoTrimName = ""
@@ -121,6 +167,13 @@ class Kbb:
         self.callsMade = 0
         self.rateLimit = float("inf")
         self.report = report
+        self.mileageBucket = mileageBucket #Share cached values between mileages rounded to this many miles, 0 is exact
+        self.valueFromCache = False
+        self.resolutions = None #CatalogCache the vehicles of one batch share their resolved KBB vehicle through
+        self.budget = None #Hold on the batch's CallBudget every KBB call is spent from
+        self.forceResolve = False #Resolve the vehicle again even if resolutionStore has it
+        self.resolvedFromStore = False
+        self.failedTemporarily = False #The vehicle's last error was one a later retry can get past, kept after the report like rateLimit
         self.debug = False
         self.warnings = []
     
@@ -133,7 +186,6 @@ class Kbb:
         self.params = {"api_key": self.api_key}
         self.data = {}
         self.requestType = ""
-        self.lastRequestTime = datetime.now()
 
     def doneProcessingVehicle(self):
         self.resetRequest()
@@ -150,92 +202,176 @@ class Kbb:
         self.configuration = []
         self.configurationWithNames = []
         self.usedLowestPricedTrim = False
+        self.valueFromCache = False
+        self.resolvedFromStore = False
         self.callsMade = 0
         self.warnings = []
 
     def setParams(self, params):
         self.params.update(params)
 
+    def run(self, flow):
+        #Runs a valuation flow. Flows are generators that yield every KBB call, cache lookup and blocking
+        #step they need and get its result back, so Kbb and AsyncKbb share one copy of the flow logic.
+        #Kbb runs the steps on this thread, AsyncKbb overrides run and runStep to await them.
+        result, error = None, None
+        while True:
+            try:
+                step = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration as done:
+                return done.value
+            try:
+                result, error = self.runStep(*step), None
+            except Exception as e:
+                result, error = None, e
+
+    def runStep(self, kind, *args):
+        if kind == self.CALL:
+            return self.sendRequest(*args)
+        if kind == self.CACHED:
+            cache, method, key, flow = args
+            return getattr(cache, method)(key, lambda: self.run(flow()))
+        if kind == self.PARALLEL:
+            return self.runParallel(args[0])
+        if kind == self.BLOCKING:
+            return args[0](*args[1:])
+        raise ValueError("Unknown flow step: " + str(kind))
+
+    def runParallel(self, flows):
+        futures = [self.trimExecutor.submit(self.run, flow()) for flow in flows]
+        results = [None] * len(futures)
+        failed = None
+        for index, future in enumerate(futures):
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                failed = e
+                #Stop running the remaining flows, one failing fails them all
+                for pending in futures[index + 1:]:
+                    pending.cancel()
+                break
+        if failed:
+            raise failed
+        return results
+
     def submitRequest(self, retries=99): #20 max retries before failing a request ~20 seconds per request
+        #Yields the pending request on self, which is free for the next one as soon as this is sent
+        step = (self.CALL, self.requestType, self.url, self.params, self.data, retries)
+        self.resetRequest()
+        return (yield step)
+
+    def sendRequest(self, requestType, url, params, data, retries=99):
+        #Doesn't use the pending request on self, so it is safe to call from several threads at once
+        key = self.getRequestKey(requestType, url, params, data)
+        #Each vehicle spends from its own budget before joining a shared call, so one batch's budget
+        #never pays for, or fails, another batch's vehicles
+        if self.budget:
+            self.budget.spend()
+        response, shared = self.singleFlight.do(key, self.getEndpointName(url), lambda: self.fetchResponse(requestType, url, params, data, retries))
+        if shared and self.budget:
+            self.budget.refund()
+        return self.readSharedResponse(*response) if shared else self.readResponse(*response[:3])
+
+    def getRequestKey(self, requestType, url, params, data):
+        #Requests that only differ by API key get the same answer
+        params = tuple(sorted((name, str(value)) for name, value in params.items() if name != "api_key"))
+        return (requestType, url, params, json.dumps(data, sort_keys=True) if data else None)
+
+    def getEndpointName(self, url):
+        return self.KBB_VIN_ENDPOINT if url.startswith(self.KBB_VIN_ENDPOINT) else url
+
+    def fetchResponse(self, requestType, url, params, data, retries=99):
         #print('----BEGIN KBB CALL--------')
         if retries > self.KBB_MAX_RETRIES:
             retries = self.KBB_MAX_RETRIES
-        while (datetime.now() - self.lastRequestTime).total_seconds() < self.KBB_TIME_WAIT:
-            sleep(self.KBB_TIME_WAIT/5)
-        if self.requestType == "POST":
-            #print("------REQUEST DATA:" + str(self.data))
-            #print("------REQUEST PARAMS: " + str(self.params))
-            ret = requests.post(self.KBB_API_ENDPOINT + self.url, params = self.params, json = self.data)
-        else: #DEFAULT IS GET
-            #print("------VIN LOOKUP: " + self.url)
-            #print("------REQUEST PARAMS: " + str(self.params))
-            ret = requests.get(self.KBB_API_ENDPOINT + self.url, params=self.params)
-        if "X-RateLimit-Remaining-Day" in ret.headers: 
-            self.rateLimit = float(ret.headers["X-RateLimit-Remaining-Day"]) #Update the remaining daily count
-        if ret.status_code == 429: #Retry if hit the per second rate limit
-            if "X-RateLimit-Remaining-Day" in ret.headers and float(ret.headers["X-RateLimit-Remaining-Day"]) > 0:
-                sleep(self.KBB_RETRY_WAIT)
+        endpoint = self.getEndpointName(url)
+        while True:
+            self.rateLimiter.acquire()
+            started = monotonic()
+            try:
+                if requestType == "POST":
+                    #print("------REQUEST DATA:" + str(data))
+                    #print("------REQUEST PARAMS: " + str(params))
+                    ret = self.session.post(self.KBB_API_ENDPOINT + url, params = params, json = data)
+                else: #DEFAULT IS GET
+                    #print("------VIN LOOKUP: " + url)
+                    #print("------REQUEST PARAMS: " + str(params))
+                    ret = self.session.get(self.KBB_API_ENDPOINT + url, params=params)
+            except Exception:
+                self.metrics.observeCall(endpoint, "error", monotonic() - started)
+                raise
+            self.metrics.observeCall(endpoint, ret.status_code, monotonic() - started)
+            if self.shouldRetry(ret.status_code, ret.headers, retries):
                 #print("Retry #: " + str(self.KBB_MAX_RETRIES + 1 - retries) + " out of " + str(self.KBB_MAX_RETRIES))
-                return self.submitRequest(retries-1)
-        jsonResponse = ret.json()
+                self.metrics.countRetry(endpoint, ret.status_code)
+                retries -= 1
+                continue
+            break
+        return ret.status_code, ret.json(), ret.content, ret.headers
+
+    def shouldRetry(self, statusCode, headers, retries):
+        self.rateLimiter.update(statusCode, headers)
+        self.readRateLimit(headers)
+        #Retry if hit the per second rate limit
+        return statusCode == 429 and retries > 0 and self.rateLimit > 0 and "X-RateLimit-Remaining-Day" in headers
+
+    def readRateLimit(self, headers):
+        if "X-RateLimit-Remaining-Day" in headers: 
+            self.rateLimit = float(headers["X-RateLimit-Remaining-Day"]) #Update the remaining daily count
+            if self.budget:
+                self.budget.cap(self.rateLimit)
+
+    def readResponse(self, statusCode, jsonResponse, content, shared=False):
         #print("------KBB RESPONSE: " + str(jsonResponse))
         #print("----END KBB CALL-------")
-        if "warnings" in jsonResponse:
-            self.warnings = self.warnings + ret.json()["warnings"]
-        self.resetRequest()
-        if ret.status_code == 200:
-            self.callsMade += 1
+        with self.lock:
+            if "warnings" in jsonResponse:
+                self.warnings = self.warnings + jsonResponse["warnings"]
+            if statusCode == 200 and not shared:
+                self.callsMade += 1
+        if statusCode == 200:
             #print(self.KBB_SUCCESS_LOG_MESSAGE)
             return jsonResponse
-        raise Exception('The KBB API responded with a ' + str(ret.status_code) + ' status code: ' + ret.content.decode("utf-8"))
+        message = 'The KBB API responded with a ' + str(statusCode) + ' status code: ' + content.decode("utf-8")
+        if statusCode == 429 or statusCode >= 500:
+            raise KbbUnavailableError(message)
+        raise Exception(message)
 
-    def getTrimsByVin(self, vin):
+    def readSharedResponse(self, statusCode, jsonResponse, content, headers):
+        #Another vehicle made the call, so it isn't counted and the response is copied before use
+        self.readRateLimit(headers)
+        return self.readResponse(statusCode, copy.deepcopy(jsonResponse), content, shared=True)
+
+    def setVinRequest(self, vin):
         self.params["VehicleClass"] = "UsedCar"
         self.url = self.KBB_VIN_ENDPOINT + vin
-        result =  self.submitRequest()
+
+    def decodeVin(self, vin):
+        self.setVinRequest(vin)
+        return self.readVinResults((yield from self.submitRequest()))
+
+    def readVinResults(self, result):
         if "vinResults" in result:
-            self.trims = result["vinResults"]
-            return self.trims
+            return result["vinResults"]
         else: 
             if "message" in result:
                 raise Exception(result["message"])
             else:
                 raise Exception(str(result))
 
+    def getTrimsByVin(self, vin):
+        #The matched trim's option names get cleaned in place, so never hand out the cached copy
+        self.trims = copy.deepcopy((yield (self.CACHED, self.vinCache, "get", vin, lambda: self.decodeVin(vin))))
+        return self.trims
+
     def convertServcoTrimName(self, trimName):
-        convertedTrimName = []
-        for trimWord in trimName.split():
-            if trimWord.upper() in self.TRIM_IGNORE:
-                break
-            for acro, word in self.TRIM_CONVERSION.items():
-                if acro.upper() == trimWord.upper():
-                    trimWord = word
-                    break
-            convertedTrimName.append(trimWord)
-        #print(' '.join(convertedTrimName))
-        return ' '.join(convertedTrimName)
-        # for acro, word in self.TRIM_CONVERSION.items():
-        #     for trimWord in trimName.split():
-        #         convertedTrimName += trimWord.replace(acro, word)
-        # return trimName
+        return self.names.convertTrimName(trimName)
 
     def convertServcoOptionName(self, optionName):
-        convertedOptionName = []
-        match = False
-        for word in optionName.split():
-            for replace, replacement in self.OPTION_CONVERSION.items():
-                if replace.upper() == word.upper():
-                    convertedOptionName.append(replacement.upper())
-                    match = True
-                    break
-            if not match:
-                convertedOptionName.append(word)
-        return " ".join(convertedOptionName)
+        return self.names.convertOptionName(optionName)
 
     def filterServcoOptions(self, options):
-        for blacklist in self.OPTION_IGNORE:
-            options = [option for option in options if not blacklist.upper() in option.upper()]
-        return options
+        return self.names.filterOptions(options)
 
     def getTrimNames(self):
         trimNames = []
@@ -245,7 +381,10 @@ class Kbb:
         return trimNames
 
     def getVehicleByVinAndTrim(self, vin, trimName):
-        self.trims = self.getTrimsByVin(vin)
+        self.trims = yield from self.getTrimsByVin(vin)
+        return self.matchVinTrim(trimName)
+
+    def matchVinTrim(self, trimName):
         trims = self.trims
         trimWords = []
         if trimName:
@@ -267,46 +406,104 @@ class Kbb:
         else:
             return None
 
+    def getTrimValue(self, trim, mileage, zipCode):
+        values = (yield from self.lookupValue(trim["vehicleId"], mileage, zipCode, []))[0]
+        return self.readTrimValue(values)
+
+    def readTrimValue(self, values):
+        for value in values.get("prices", []):
+            #Use 'Typical Listing Price' 
+            if value["priceTypeId"] == 2:
+                return value["configuredValue"], values
+        return None, values
+
     def getVehicleByLowestPricedTrim(self, mileage, zipCode):
+        #Price every trim at once, then pick the lowest in trim order so ties always resolve to the first trim.
+        #A trim that fails to price fails the vehicle, it can't be priced this way.
+        #Trims have no price until vehicle/values is called for them, so only pricing all of them finds the lowest.
+        #With KBB_LOWEST_TRIM_STOP_PRICE set they're priced a wave at a time in trim order instead, and the first
+        #wave with a trim at or below that price is the last one, a cheaper trim in a later wave is missed.
+        trims = list(self.trims)
+        waveSize = max(self.KBB_LOWEST_TRIM_WAVE, 1) if self.KBB_LOWEST_TRIM_STOP_PRICE else max(len(trims), 1)
+        pricedTrims = []
+        results = []
+        for start in range(0, len(trims), waveSize):
+            wave = trims[start:start + waveSize]
+            results = results + (yield (self.PARALLEL, [lambda trim=trim: self.getTrimValue(trim, mileage, zipCode) for trim in wave]))
+            pricedTrims = pricedTrims + wave
+            if self.KBB_LOWEST_TRIM_STOP_PRICE and any(value is not None and value <= self.KBB_LOWEST_TRIM_STOP_PRICE for value, values in results):
+                break
+        return self.useLowestPricedTrim(pricedTrims, results)
+
+    def useLowestPricedTrim(self, trims, results):
         useValue = float("inf")
         useTrim = {}
-        currValue = float("inf")
-        trimValues = []
-        #Try to find the lowest priced trim
-        for trim in self.trims:
-            values = self.getValueByVehicleId(trim["vehicleId"], mileage, zipCode, [])
-            if "prices" in values:
-                trimValues = values["prices"]
-            for value in trimValues:
-                #Use 'Typical Listing Price' 
-                if value["priceTypeId"] == 2:
-                    currValue = value["configuredValue"]
-                    break
-            if useValue > currValue:
-                useValue = currValue
+        for trim, (value, values) in zip(trims, results):
+            if value is not None and useValue > value:
+                useValue = value
                 useTrim = trim 
+            self.values = values
+        self.values = copy.deepcopy(self.values)
         self.usedLowestPricedTrim = True
         self.vehicle = useTrim
         return useTrim
 
     def getVehicleIdByVinAndTrim(self, vin, trimName):
-        return self.getVehicleByVinAndTrim(vin, trimName)
+        return (yield from self.getVehicleByVinAndTrim(vin, trimName))
+
+    def bucketMileage(self, mileage):
+        if self.mileageBucket and isinstance(mileage, int):
+            return int(round(mileage / self.mileageBucket) * self.mileageBucket)
+        return mileage
+
+    def getValuesRequest(self, vehicleId, mileage, zipCode, vehicleOptionIds):
+        data = {"configuration": {"vehicleId": vehicleId, "vehicleOptionIds": list(vehicleOptionIds)}, "mileage": mileage, "zipCode": zipCode}#, "valuationDate": self.valuationDate}
+        return "POST", self.KBB_VEHICLE_VALUE_ENDPOINT, {"api_key": self.api_key}, data
+
+    def getValues(self, vehicleId, mileage, zipCode, vehicleOptionIds):
+        return (yield (self.CALL, *self.getValuesRequest(vehicleId, mileage, zipCode, vehicleOptionIds)))
+
+    def getValueKey(self, vehicleId, mileage, zipCode, vehicleOptionIds):
+        return (vehicleId, tuple(sorted(vehicleOptionIds)), mileage, zipCode)
+
+    def replayValueWarnings(self, values):
+        if "warnings" in values:
+            with self.lock:
+                self.warnings = self.warnings + values["warnings"]
+
+    def lookupValue(self, vehicleId, mileage, zipCode, vehicleOptionIds):
+        #Returns the shared vehicle/values response and whether it came from the cache, safe to call from several threads
+        mileage = self.bucketMileage(mileage)
+        key = self.getValueKey(vehicleId, mileage, zipCode, vehicleOptionIds)
+        fetched = []
+        def fetch():
+            fetched.append(True)
+            return (yield from self.getValues(vehicleId, mileage, zipCode, vehicleOptionIds))
+        values = yield (self.CACHED, self.valueCache, "get", key, fetch)
+        if not fetched:
+            self.replayValueWarnings(values)
+        return values, not fetched
 
     def getValueByVehicleId(self, vehicleId, mileage, zipCode, vehicleOptionIds):
-        self.data = {"configuration": {"vehicleId": vehicleId, "vehicleOptionIds": list(vehicleOptionIds)}, "mileage": mileage, "zipCode": zipCode}#, "valuationDate": self.valuationDate}
-        self.url = self.KBB_VEHICLE_VALUE_ENDPOINT
-        self.requestType = "POST"
-        self.values = self.submitRequest()
+        values, self.valueFromCache = yield from self.lookupValue(vehicleId, mileage, zipCode, vehicleOptionIds)
+        #Option names get added to the prices later, so never hand out the cached copy
+        self.values = copy.deepcopy(values)
         #print(self.values)
         return self.values
 
-    def getOptionsByVehicleId(self, vehicleId):
+    def setVehicleOptionsRequest(self, vehicleId):
         self.params["limit"] = self.KBB_VEHICLE_LIMIT
         self.params["vehicleId"] = vehicleId
         self.url = self.KBB_OPTION_ENDPOINT
         self.requestType = "GET"
-        options = self.submitRequest()
-        self.vehicle["vehicleOptions"] = options.get("items")
+
+    def getVehicleOptions(self, vehicleId):
+        self.setVehicleOptionsRequest(vehicleId)
+        options = yield from self.submitRequest()
+        return options.get("items")
+
+    def getOptionsByVehicleId(self, vehicleId):
+        self.vehicle["vehicleOptions"] = yield (self.CACHED, self.optionsCache, "get", vehicleId, lambda: self.getVehicleOptions(vehicleId))
         return self.values
 
     def getTypicalOptions(self):
@@ -318,6 +515,10 @@ class Kbb:
                 self.vinDecodedOptions.append(option)
 
     def updateConfiguration(self, newConfigurationIds):
+        self.setConfigurationRequest(newConfigurationIds)
+        self.readConfiguration((yield from self.submitRequest()))
+
+    def setConfigurationRequest(self, newConfigurationIds):
         self.data = {}
         self.data["StartingConfiguration"] = {"VehicleId": self.vehicle["vehicleId"]}
         if self.configuration:
@@ -330,12 +531,15 @@ class Kbb:
 
         self.url = self.KBB_VEHICLE_CONFIG_ENDPOINT
         self.requestType = "POST"
-        response = self.submitRequest()
 
+    def readConfiguration(self, response):
         if "finalConfiguration" in response and "vehicleOptionIds" in response["finalConfiguration"]:
             self.configuration = response["finalConfiguration"]["vehicleOptionIds"]
 
     def getConfiguration(self):
+        yield from self.updateConfiguration(self.getConfigurationChanges())
+
+    def getConfigurationChanges(self):
         self.getTypicalOptions()
 
         vehicleConfiguration = []
@@ -343,8 +547,7 @@ class Kbb:
             vehicleConfiguration.append(option["vehicleOptionId"])
         for option in self.vinDecodedOptions:
             vehicleConfiguration.append(option["vehicleOptionId"])
-
-        self.updateConfiguration(vehicleConfiguration)
+        return vehicleConfiguration
 
     def getOptionNamesFromTrimName(self, options):
         if self.servcoTrimName:
@@ -368,85 +571,113 @@ class Kbb:
 
     def cleanKBBOptionNames(self, options):
         for index in range(len(options)):
-            for substr in self.OPTION_REMOVE:
-                options[index]['optionName'] = options[index]['optionName'].replace(substr, "")
+            options[index]['optionName'] = self.names.cleanName(options[index]['optionName'])
         return options
 
     def cleanOptionNames(self, options):
         for index in range(len(options)):
-            for substr in self.OPTION_REMOVE:
-                options[index] = options[index].replace(substr, "")
+            options[index] = self.names.cleanName(options[index])
         return options
 
     def getMatchingVehicleOptionCodes(self, options):
-        cleanedOptions = self.cleanKBBOptionNames(self.vehicle["vehicleOptions"])
-        KBBVehicleOptions = cleanedOptions
-        
+        KBBVehicleOptions = self.cleanKBBOptionNames(self.vehicle["vehicleOptions"])
+
         options = self.getOptionNamesFromTrimName(options)
         options = self.getOptionNamesFromModelName(options)
         if options:
             self.originalOptionNames = options
             options = self.convertOptionNames(options)
-        matchedOptions = []
-        #print(str(len(options)))
-        for option in options:
-            matchCount = 0
-            #print('--------------------------------------------------------------')
-            #print(option)
-            for optionWord in option.split():
-                savedOptions = KBBVehicleOptions
-                KBBVehicleOptions = list(filter(lambda x: (optionWord.upper() in x["optionName"].replace(",", "").upper().split()), KBBVehicleOptions))
-                #print('--' + optionWord)
-                #print('--' + str( [x["optionName"] for x in KBBVehicleOptions ]))
-                
-                if len(KBBVehicleOptions) == 1:  #Only one option remains
-                    matchCount += 1
-                    #print('----' + str(matchCount))
-                    if (optionWord.upper() in (x.upper() for x in self.BYPASS_OPTIONS)
-                    or optionWord.upper() in (x.upper() for x in self.OPTIONS_IN_TRIM) 
-                    or matchCount/len(KBBVehicleOptions[0]["optionName"].split()) > self.OPTION_MATCH_PERCENTAGE):
-                        #print('*------' + str(KBBVehicleOptions[0]))
-                        matchedOptions.append(KBBVehicleOptions[0])
-                        break
-                elif len(KBBVehicleOptions) > 0: #At least one option matched the current word
-                    matchCount+=1
-                elif len(KBBVehicleOptions) == 0:  #None of the options matched the current word so reset
-                    KBBVehicleOptions = savedOptions
-            KBBVehicleOptions = cleanedOptions
+        #The index only depends on the option names, so vehicles sharing a vehicleId share one
+        optionNames = tuple(option["optionName"] for option in KBBVehicleOptions)
+        index = self.optionIndexCache.get((self.vehicle["vehicleId"], optionNames), lambda: OptionIndex(optionNames))
+        bypassWords = {word.upper() for word in self.BYPASS_OPTIONS + self.OPTIONS_IN_TRIM}
+        matchedOptions = [KBBVehicleOptions[match] for match in index.match(options, bypassWords, self.OPTION_MATCH_PERCENTAGE) if match is not None]
         #print(str(matchedOptions))
         self.matchedOptions = matchedOptions
         return matchedOptions
 
-    def getValueByVinAndTrim(self, vin, trimName, mileage, zipCode, options):
-        self.vehicle = self.getVehicleIdByVinAndTrim(vin, trimName)
+    @staticmethod
+    def squishVin(vin):
+        #Positions 1-8 and 10 of a VIN, they identify the vehicle down to the trim and model year
+        vin = str(vin).strip().upper()
+        return vin[:8] + vin[9] if len(vin) == 17 else vin
+
+    def getResolutionKey(self, vin, year, makeName, modelName, trimName):
+        if vin:
+            return ("vin", self.squishVin(vin), trimName)
+        return ("name", str(year), self.makeCatalog.normalize(makeName), modelName, trimName)
+
+    def saveResolution(self):
+        return copy.deepcopy({"trims": self.trims, "vehicle": self.vehicle, "usedLowestPricedTrim": self.usedLowestPricedTrim})
+
+    def useResolution(self, resolution):
+        #Options get cleaned and attached to the vehicle later, so never use the shared copy
+        resolution = copy.deepcopy(resolution)
+        self.trims = resolution["trims"]
+        self.vehicle = resolution["vehicle"]
+        self.usedLowestPricedTrim = resolution["usedLowestPricedTrim"]
+        return self.vehicle
+
+    def resolve(self, key, resolveVehicle):
+        #Finds the KBB vehicle once per VIN squish or year/make/model and trim in a batch,
+        #the rest of the group reuse it and only run their own options and valuation calls
+        if self.resolutions is None:
+            return (yield from resolveVehicle())
+        def fetch():
+            yield from resolveVehicle()
+            return self.saveResolution()
+        return self.useResolution((yield (self.CACHED, self.resolutions, "get", key, fetch)))
+
+    def resolveVin(self, vin, trimName, mileage, zipCode):
+        self.vehicle = yield from self.getVehicleIdByVinAndTrim(vin, trimName)
         if not self.vehicle:
-            self.vehicle = self.getVehicleByLowestPricedTrim(mileage, zipCode)
-        vehicleId = self.vehicle["vehicleId"]
+            self.vehicle = yield from self.getVehicleByLowestPricedTrim(mileage, zipCode)
+        return self.vehicle
+
+    def resolveByVinAndTrim(self, vin, trimName, mileage, zipCode, options):
+        key = self.getResolutionKey(vin, None, None, None, trimName)
+        self.vehicle = yield from self.resolve(key, lambda: self.resolveVin(vin, trimName, mileage, zipCode))
         self.getMatchingVehicleOptionCodes(options)
-        self.getConfiguration()
-        value = self.getValueByVehicleId(vehicleId, mileage, zipCode, self.configuration)
-        return value
+        yield from self.getConfiguration()
+        return self.vehicle
 
-    def getMakeIdByName(self, makeName):
+    def getValueByVinAndTrim(self, vin, trimName, mileage, zipCode, options):
+        yield from self.resolveByVinAndTrim(vin, trimName, mileage, zipCode, options)
+        return (yield from self.priceVehicle(mileage, zipCode))
+
+    def setMakesRequest(self):
         self.params["limit"] = self.KBB_VEHICLE_LIMIT
         self.url = self.KBB_VEHICLE_MAKE_ENDPOINT
-        makes = self.submitRequest()
-        makeId = 0
-        for make in makes["items"]:
-            if make["makeName"].upper() == makeName.upper():
-                makeId = make["makeId"]
-                exit
+
+    def getMakes(self):
+        self.setMakesRequest()
+        makes = yield from self.submitRequest()
+        return makes["items"]
+
+    def getMakeIdByName(self, makeName):
+        return self.checkMakeId((yield (self.CACHED, self.makeCatalog, "getMakeId", makeName, self.getMakes)))
+
+    def checkMakeId(self, makeId):
         if not makeId > 0:
             raise Exception("Could not determine KBB make.")
         return makeId
 
-    def getModelIdByName(self, year, makeName, modelName):
-        makeId = self.getMakeIdByName(makeName)
+    def setModelsRequest(self, year, makeId):
         self.params["limit"] = self.KBB_VEHICLE_LIMIT
         self.params["makeid"] = makeId
         self.params["yearid"] = year
         self.url = self.KBB_VEHICLE_MODEL_ENDPOINT
-        models = self.submitRequest()
+
+    def getModels(self, year, makeId):
+        self.setModelsRequest(year, makeId)
+        return (yield from self.submitRequest())
+
+    def getModelIdByName(self, year, makeName, modelName):
+        makeId = yield from self.getMakeIdByName(makeName)
+        models = yield (self.CACHED, self.modelCatalog, "get", (str(year), makeId), lambda: self.getModels(year, makeId))
+        return self.findModelId(models, modelName)
+
+    def findModelId(self, models, modelName):
         modelIds = []
         for model in models["items"]:
             #Only doing a direct compare for now, possible regex compare later
@@ -459,18 +690,28 @@ class Kbb:
             raise Exception("Could not narrow down KBB model IDs: " + str(modelIds))
         return modelIds[0]
 
-    def getTrimsByModelId(self, year, makeName, modelName):
-        modelId = self.getModelIdByName(year, makeName, modelName)
+    def setVehiclesRequest(self, year, modelId):
         self.params["limit"] = self.KBB_VEHICLE_LIMIT
         self.params["modelId"] = modelId
         self.params["yearId"] = year
         self.url = self.KBB_VEHICLE_VEHICLES_ENDPOINT
-        trims = self.submitRequest()
-        return trims
+
+    def getVehicles(self, year, modelId):
+        self.setVehiclesRequest(year, modelId)
+        return (yield from self.submitRequest())
+
+    def getTrimsByModelId(self, year, makeName, modelName):
+        modelId = yield from self.getModelIdByName(year, makeName, modelName)
+        trims = yield (self.CACHED, self.trimCatalog, "get", (modelId, str(year)), lambda: self.getVehicles(year, modelId))
+        #The matched trim gets its options attached later, so never hand out the cached copy
+        return copy.deepcopy(trims)
 
     def getVehicleByName(self, year, makeName, modelName, trimName):
-        trims = self.getTrimsByModelId(year, makeName, modelName)
+        trims = yield from self.getTrimsByModelId(year, makeName, modelName)
         self.trims = trims["items"]
+        return self.matchTrimByName(trimName)
+
+    def matchTrimByName(self, trimName):
         vehicles = self.trims
         trimWords = trimName.split()
         for trimWord in trimWords:
@@ -482,7 +723,9 @@ class Kbb:
         return vehicles[0]
 
     def getVehicleIdByName(self, year, makeName, modelName, trimName):
-        vehicle = self.getVehicleByName(year, makeName, modelName, trimName)
+        return self.useVehicle((yield from self.getVehicleByName(year, makeName, modelName, trimName)))
+
+    def useVehicle(self, vehicle):
         if vehicle and "vehicleId" in vehicle:
             self.vehicle = vehicle
             return vehicle["vehicleId"]
@@ -490,28 +733,117 @@ class Kbb:
             return None
 
     def getVehicleIdByNameNoTrim(self, year, makeName, modelName, mileage, zipCode):
-        self.trims = self.getTrimsByModelId(year, makeName, modelName)["items"]
-        self.vehicle = self.getVehicleByLowestPricedTrim(mileage, zipCode)
+        self.trims = (yield from self.getTrimsByModelId(year, makeName, modelName))["items"]
+        self.vehicle = yield from self.getVehicleByLowestPricedTrim(mileage, zipCode)
         vehicleId = self.vehicle["vehicleId"]
         return vehicleId
 
-    def getValueByName(self, year, makeName, modelName, trimName, mileage, zipCode, options = []):
+    def resolveName(self, year, makeName, modelName, trimName, mileage, zipCode):
         vehicleId = None
         if trimName and modelName.strip() != trimName.strip():
-            vehicleId = self.getVehicleIdByName(year, makeName, modelName, trimName)
+            vehicleId = yield from self.getVehicleIdByName(year, makeName, modelName, trimName)
         if not vehicleId:
-            vehicleId = self.getVehicleIdByNameNoTrim(year, makeName, modelName, mileage, zipCode)
-        self.getOptionsByVehicleId(vehicleId)
+            vehicleId = yield from self.getVehicleIdByNameNoTrim(year, makeName, modelName, mileage, zipCode)
+        return self.vehicle
+
+    def resolveByName(self, year, makeName, modelName, trimName, mileage, zipCode, options = []):
+        key = self.getResolutionKey(None, year, makeName, modelName, trimName)
+        vehicleId = (yield from self.resolve(key, lambda: self.resolveName(year, makeName, modelName, trimName, mileage, zipCode)))["vehicleId"]
+        yield from self.getOptionsByVehicleId(vehicleId)
         self.getMatchingVehicleOptionCodes(options)
-        self.getConfiguration()
-        return self.getValueByVehicleId(vehicleId, mileage, zipCode, self.configuration)
+        yield from self.getConfiguration()
+        return self.vehicle
+
+    def getValueByName(self, year, makeName, modelName, trimName, mileage, zipCode, options = []):
+        yield from self.resolveByName(year, makeName, modelName, trimName, mileage, zipCode, options)
+        return (yield from self.priceVehicle(mileage, zipCode))
+
+    #Resolving finds the KBB vehicle and its configured options, pricing only makes the vehicle/values call.
+    #A resolved vehicle is the same run after run, so resolutionStore keeps it and pricing it again is one call.
+    def getStoredKey(self, id, vin):
+        return "vin:" + VinCache.normalize(vin) if vin else "id:" + str(id)
+
+    def getInputHash(self, vin, year, makeName, modelName, trimName, options):
+        inputs = [VinCache.normalize(vin) if vin else "", str(year), str(makeName), str(modelName), str(trimName), sorted(str(option) for option in options or [])]
+        return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+    def saveResolvedVehicle(self):
+        return copy.deepcopy({"vehicle": self.vehicle,
+                              "trims": self.trims,
+                              "usedLowestPricedTrim": self.usedLowestPricedTrim,
+                              "originalOptionNames": list(self.originalOptionNames),
+                              "typicalOptions": self.typicalOptions,
+                              "vinDecodedOptions": self.vinDecodedOptions,
+                              "matchedOptions": self.matchedOptions,
+                              "configuration": self.configuration})
+
+    def loadResolvedVehicle(self, resolved):
+        resolved = copy.deepcopy(resolved)
+        self.vehicle = resolved["vehicle"]
+        self.trims = resolved["trims"]
+        self.usedLowestPricedTrim = resolved["usedLowestPricedTrim"]
+        self.originalOptionNames = resolved["originalOptionNames"]
+        self.typicalOptions = resolved["typicalOptions"]
+        self.vinDecodedOptions = resolved["vinDecodedOptions"]
+        self.matchedOptions = resolved["matchedOptions"]
+        self.configuration = resolved["configuration"]
+        self.resolvedFromStore = True
+        return self.vehicle
+
+    def findStoredVehicle(self, id, vin, year, makeName, modelName, trimName, options):
+        #Returns (key, inputHash, resolved), resolved is None when the vehicle has to be resolved
+        if self.resolutionStore is None:
+            return None, None, None
+        key = self.getStoredKey(id, vin)
+        inputHash = self.getInputHash(vin, year, makeName, modelName, trimName, options)
+        if self.forceResolve:
+            return key, inputHash, None
+        return key, inputHash, (yield (self.BLOCKING, self.resolutionStore.get, key, inputHash))
+
+    def storeResolvedVehicle(self, key, inputHash):
+        if self.resolutionStore is not None:
+            yield (self.BLOCKING, self.resolutionStore.put, key, inputHash, self.saveResolvedVehicle())
+
+    def resolveVehicle(self, id, vin, year, makeName, modelName, trimName, mileage, zipCode, options):
+        key, inputHash, resolved = yield from self.findStoredVehicle(id, vin, year, makeName, modelName, trimName, options)
+        if resolved is not None:
+            return self.loadResolvedVehicle(resolved)
+        if vin:
+            yield from self.resolveByVinAndTrim(vin, trimName, mileage, zipCode, options)
+        else:
+            yield from self.resolveByName(year, makeName, modelName, trimName, mileage, zipCode, options)
+        yield from self.storeResolvedVehicle(key, inputHash)
+        return self.vehicle
+
+    def priceVehicle(self, mileage, zipCode):
+        return (yield from self.getValueByVehicleId(self.vehicle["vehicleId"], mileage, zipCode, self.configuration))
+
+    @classmethod
+    def getCacheStats(cls):
+        return {"models": cls.modelCatalog.getStats(),
+                "trims": cls.trimCatalog.getStats(),
+                "vins": cls.vinCache.getStats(),
+                "options": cls.optionsCache.getStats(),
+                "optionIndexes": cls.optionIndexCache.getStats(),
+                "names": cls.names.getStats(),
+                "values": cls.valueCache.getStats(),
+                **({"resolutions": cls.resolutionStore.getStats()} if cls.resolutionStore is not None else {})}
+
+    @classmethod
+    def refreshCatalogs(cls):
+        cls.makeCatalog.refresh()
+        cls.modelCatalog.invalidate()
+        cls.trimCatalog.invalidate()
+        cls.optionsCache.invalidate()
+        cls.optionIndexCache.invalidate()
+        cls.valueCache.invalidate()
 
     def compareVehicleVinAndName(self, vin, year, makeName, modelName, trimName):
-        return self.getVehicleIdByName(year, makeName, modelName, trimName) == self.getVehicleIdByVinAndTrim(vin, trimName)
+        return (yield from self.getVehicleIdByName(year, makeName, modelName, trimName)) == (yield from self.getVehicleIdByVinAndTrim(vin, trimName))
 
     def addOptionNames(self):
         optionById = {}
-        for option in self.vehicle.get("vehicleOptions"):
+        for option in self.vehicle.get("vehicleOptions") or []: #Nothing to name when the vehicle was never resolved
             optionById[str(option["vehicleOptionId"])] = option["optionName"]
         if "prices" in self.values:
             for i, price in enumerate(self.values.get("prices")):
@@ -546,6 +878,8 @@ class Kbb:
             availableVehicleOptions = str( [ x.get("optionName") + ' (' + str(x.get("vehicleOptionId")) + ')' for x in self.vehicle.get("vehicleOptions")])
 
         usedLowestPricedTrim = self.usedLowestPricedTrim
+        valueFromCache = self.valueFromCache
+        resolvedFromStore = self.resolvedFromStore
         callsMade = self.callsMade
         self.doneProcessingVehicle()
         return {"errors": errors,
@@ -553,6 +887,8 @@ class Kbb:
                 "numCallsMade": callsMade, 
                 #"valuationDate": valuationDate,
                 "usedLowestPricedTrim": usedLowestPricedTrim,
+                "valueFromCache": valueFromCache,
+                "resolvedFromStore": resolvedFromStore,
                 "originalTrim": trimName, 
                 "convertedTrim": trimNameConverted, 
                 "availableTrims": trimNames, 
@@ -574,6 +910,8 @@ class Kbb:
         self.addOptionNames()
         prices = self.values.get("prices")
         usedLowestPricedTrim = self.usedLowestPricedTrim
+        valueFromCache = self.valueFromCache
+        resolvedFromStore = self.resolvedFromStore
         #valuationDate = self.values.get("valuationDate")
         warnings = self.warnings
         self.doneProcessingVehicle()
@@ -581,15 +919,39 @@ class Kbb:
                 "warnings": [str(x) for x in warnings],
                 #"valuationDate": valuationDate,
                 "usedLowestPricedTrim": usedLowestPricedTrim,
+                "valueFromCache": valueFromCache,
+                "resolvedFromStore": resolvedFromStore,
                 "numCallsMade": callsMade, 
                 "prices": prices}
 
     def getVehicleValue(self, id, vin, year, makeName, modelName, trimName, mileage, zipCode, vehicleOptions): #valuationDate=datetime.today().strftime('%m/%d/%Y')):
+        #The report for one vehicle, AsyncKbb returns a coroutine of it
+        return self.run(self.valueVehicle(id, vin, year, makeName, modelName, trimName, mileage, zipCode, vehicleOptions))
+
+    def valueVehicle(self, id, vin, year, makeName, modelName, trimName, mileage, zipCode, vehicleOptions):
         errors = []
         values = {}
 
         #self.valuationDate = valuationDate
         
+        trimNameConverted = self.startVehicle(id, modelName, trimName)
+        try:
+            yield from self.resolveVehicle(id, vin, year, makeName, modelName, trimNameConverted, mileage, zipCode, vehicleOptions)
+            self.values = yield from self.priceVehicle(mileage, zipCode)
+        except Exception as e:
+            errors.append(str(e))
+            self.noteError(e)
+        return self.finishVehicle(trimName, trimNameConverted, vehicleOptions, errors)
+
+    def isTemporaryError(self, e):
+        #Throttling, KBB server errors, dropped connections and timeouts, unlike a vehicle KBB can't match
+        return isinstance(e, (KbbUnavailableError, BudgetUsedUpError, requests.exceptions.RequestException))
+
+    def noteError(self, e):
+        self.failedTemporarily = self.isTemporaryError(e)
+
+    def startVehicle(self, id, modelName, trimName):
+        self.failedTemporarily = False
         trimNameConverted = trimName
         if trimName:
             trimNameConverted = self.convertServcoTrimName(trimName)
@@ -602,17 +964,12 @@ class Kbb:
         self.servcoModelName = modelNameConverted
         
         self.id = id
-        try:
-            if vin:
-                values = self.getValueByVinAndTrim(vin, trimNameConverted, mileage, zipCode, vehicleOptions)
-            else:
-                values = self.getValueByName(year, makeName , modelName, trimNameConverted, mileage, zipCode, vehicleOptions)
-            self.values = values
-        except Exception as e:
-            errors.append(str(e))
+        return trimNameConverted
+
+    def finishVehicle(self, trimName, trimNameConverted, vehicleOptions, errors):
         if not self.originalOptionNames and vehicleOptions:
             self.originalOptionNames = vehicleOptions
         if self.report:
             return self.generateKBBReport(trimName, trimNameConverted, errors)
         else:
-            return self.generateReturnValues(errors)
\ No newline at end of file
+            return self.generateReturnValues(errors)
@@ -0,0 +1,269 @@
+import os
+import asyncio
+import json
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from time import monotonic
+from types import MappingProxyType
+
+class MakeCatalog:
+    DEFAULT_TTL = 86400 #Seconds before the makes list is downloaded again
+
+    def __init__(self, ttl=DEFAULT_TTL) -> None:
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.makeIds = {}
+        self.loadedAt = None
+        self.loads = 0
+
+    @staticmethod
+    def normalize(makeName):
+        return " ".join(str(makeName).split()).upper()
+
+    def isExpired(self):
+        return self.loadedAt is None or monotonic() - self.loadedAt >= self.ttl
+
+    def load(self, makes):
+        makeIds = {}
+        for make in makes:
+            makeIds[self.normalize(make["makeName"])] = make["makeId"]
+        self.makeIds = makeIds
+        self.loadedAt = monotonic()
+        self.loads += 1
+
+    def getMakeId(self, makeName, fetch):
+        #fetch is only called by the first thread to find the catalog missing or expired,
+        #every other thread waits on the lock and then reads the fresh index
+        with self.lock:
+            if self.isExpired():
+                self.load(fetch())
+            return self.makeIds.get(self.normalize(makeName), 0)
+
+    async def getMakeIdAsync(self, makeName, fetch):
+        #Coroutine version of getMakeId, the lock is never held while awaiting
+        if self.isExpired():
+            makes = await fetch()
+            with self.lock:
+                self.load(makes)
+        return self.makeIds.get(self.normalize(makeName), 0)
+
+    def refresh(self, fetch=None):
+        #Reload now if given a fetch function, otherwise force a reload on the next lookup
+        with self.lock:
+            if fetch:
+                self.load(fetch())
+            else:
+                self.loadedAt = None
+
+class CatalogCache:
+    DEFAULT_TTL = 86400 #Seconds before an entry is fetched again
+    DEFAULT_MAX_SIZE = 2048 #Least recently used entries are dropped past this size
+
+    def __init__(self, ttl=DEFAULT_TTL, maxSize=DEFAULT_MAX_SIZE) -> None:
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() #key -> (expiry, value)
+        self.loading = {} #key -> Event set once the fetching thread is done
+        self.asyncLoading = {} #key -> Future done once the fetching coroutine is done
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        #Returns (True, value) for a live entry, call with the lock held
+        entry = self.entries.get(key)
+        if entry and entry[0] > monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+        return False, None
+
+    def get(self, key, fetch):
+        #Only one thread fetches a missing key, the others wait for it and reuse the result.
+        #If that fetch fails the next waiting thread tries again.
+        while True:
+            with self.lock:
+                found, value = self.lookup(key)
+                if found:
+                    return value
+                loaded = self.loading.get(key)
+                if loaded is None:
+                    loaded = threading.Event()
+                    self.loading[key] = loaded
+                    self.misses += 1
+                    break
+            loaded.wait()
+        try:
+            value = fetch()
+            self.put(key, value)
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loaded.set()
+
+    async def getAsync(self, key, fetch):
+        #Coroutine version of get. Coroutines on the same event loop wait for one fetch, but it never
+        #waits on other threads' or event loops' fetches so the event loop never blocks.
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                found, value = self.lookup(key)
+                if found:
+                    return value
+                loaded = self.asyncLoading.get(key)
+                if loaded is None or loaded.get_loop() is not loop:
+                    owner = loaded is None
+                    if owner:
+                        loaded = loop.create_future()
+                        self.asyncLoading[key] = loaded
+                    self.misses += 1
+                    break
+            await asyncio.wait([loaded])
+        try:
+            value = await fetch()
+            self.put(key, value)
+            return value
+        finally:
+            if owner:
+                with self.lock:
+                    del self.asyncLoading[key]
+                loaded.set_result(None)
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def getStats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hitRate": round(self.hits / lookups, 4) if lookups else 0,
+                    "size": len(self.entries)}
+
+class OptionsCache(CatalogCache):
+    #Entries are stored read-only and every caller gets its own list of option dicts,
+    #so one vehicle cleaning or annotating its options can't change another's
+
+    def get(self, vehicleId, fetch):
+        options = super().get(vehicleId, lambda: self.freeze(fetch()))
+        return self.view(options)
+
+    async def getAsync(self, vehicleId, fetch):
+        async def fetchFrozen():
+            return self.freeze(await fetch())
+        return self.view(await super().getAsync(vehicleId, fetchFrozen))
+
+    @staticmethod
+    def freeze(options):
+        if options is None:
+            return None
+        return tuple(MappingProxyType(dict(option)) for option in options)
+
+    @staticmethod
+    def view(options):
+        if options is None:
+            return None
+        return [dict(option) for option in options]
+
+class VinCache:
+    #The temp dir only lasts as long as the container (on Cloud Run it's in memory and per instance),
+    #point path at a mounted volume to keep decodes across restarts
+    DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "kbb_vin_cache.sqlite3")
+    DEFAULT_MEMORY_SIZE = 4096 #Decodes kept in memory in front of the SQLite file
+
+    def __init__(self, path=DEFAULT_PATH, memorySize=DEFAULT_MEMORY_SIZE) -> None:
+        self.path = path #None keeps decodes in memory only
+        self.memory = CatalogCache(ttl=float("inf"), maxSize=memorySize)
+        self.local = threading.local() #sqlite connections can't be shared between threads
+        self.lock = threading.Lock()
+        self.diskHits = 0
+        self.decodes = 0
+
+    @staticmethod
+    def normalize(vin):
+        return str(vin).strip().upper()
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            #WAL plus a busy timeout lets several processes read and write the same file
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS vin_decodes (vin TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL)")
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def read(self, vin):
+        if not self.path:
+            return None
+        try:
+            row = self.connect().execute("SELECT result FROM vin_decodes WHERE vin = ?", (vin,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return json.loads(row[0]) if row else None
+
+    def write(self, vin, result):
+        if not self.path:
+            return
+        try:
+            connection = self.connect()
+            connection.execute("INSERT OR REPLACE INTO vin_decodes (vin, result, created) VALUES (?, ?, strftime('%s', 'now'))", (vin, json.dumps(result)))
+            connection.commit()
+        except sqlite3.Error:
+            pass #The disk cache is best effort, the decode is still returned
+
+    def readDisk(self, vin):
+        result = self.read(vin)
+        if result is not None:
+            with self.lock:
+                self.diskHits += 1
+        return result
+
+    def save(self, vin, result):
+        with self.lock:
+            self.decodes += 1
+        self.write(vin, result)
+        return result
+
+    def load(self, vin, fetch):
+        result = self.readDisk(vin)
+        if result is not None:
+            return result
+        return self.save(vin, fetch())
+
+    def get(self, vin, fetch):
+        #fetch should raise rather than return a failed decode so that it is never cached
+        vin = self.normalize(vin)
+        return self.memory.get(vin, lambda: self.load(vin, fetch))
+
+    async def getAsync(self, vin, fetch):
+        vin = self.normalize(vin)
+        async def load():
+            #The SQLite file is read and written on a thread so the event loop keeps running other vehicles
+            result = await asyncio.to_thread(self.readDisk, vin)
+            if result is not None:
+                return result
+            return await asyncio.to_thread(self.save, vin, await fetch())
+        return await self.memory.getAsync(vin, load)
+
+    def getStats(self):
+        stats = self.memory.getStats()
+        with self.lock:
+            stats["diskHits"] = self.diskHits
+            stats["decodes"] = self.decodes
+        return stats
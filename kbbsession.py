@@ -0,0 +1,66 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+class KbbSession:
+    DEFAULT_POOL_SIZE = 10 #Keep-alive connections held open to the KBB API
+    DEFAULT_CONNECT_TIMEOUT = 5 #Seconds to wait while opening a connection
+    DEFAULT_READ_TIMEOUT = 30 #Seconds to wait for KBB to send a response
+
+    def __init__(self, poolSize=DEFAULT_POOL_SIZE, connectTimeout=DEFAULT_CONNECT_TIMEOUT, readTimeout=DEFAULT_READ_TIMEOUT) -> None:
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        self.adapter = None
+        self.poolSize = 0
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.requestsMade = 0
+        self.retiredConnections = 0 #Connections opened by adapters that have since been replaced
+        self.setPoolSize(poolSize)
+
+    def setPoolSize(self, poolSize):
+        #The pool only ever grows so threads already using it keep their connections
+        with self.lock:
+            if poolSize <= self.poolSize:
+                return
+            if self.adapter:
+                self.retiredConnections += self.connectionsOpened(self.adapter)
+            self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+            self.session.mount("https://", self.adapter)
+            self.session.mount("http://", self.adapter)
+            self.poolSize = poolSize
+
+    def setTimeouts(self, connectTimeout, readTimeout):
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.requestsMade += 1
+        return self.session.request(method, url, timeout=(self.connectTimeout, self.readTimeout), **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def connectionsOpened(self, adapter):
+        opened = 0
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                opened += pools[key].num_connections
+            except KeyError: #Pool was evicted while counting
+                pass
+        return opened
+
+    def getStats(self):
+        with self.lock:
+            requestsMade = self.requestsMade
+            opened = self.retiredConnections + self.connectionsOpened(self.adapter)
+            poolSize = self.poolSize
+        return {"poolSize": poolSize,
+                "requests": requestsMade,
+                "connectionsOpened": opened,
+                "connectionsReused": max(requestsMade - opened, 0)}
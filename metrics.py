@@ -0,0 +1,195 @@
+import math
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from time import monotonic
+
+class Histogram:
+    def __init__(self, buckets) -> None:
+        self.buckets = buckets #Upper bounds in seconds, +Inf is implied
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def add(self, other):
+        self.counts = [count + otherCount for count, otherCount in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        #Estimated like Prometheus' histogram_quantile, interpolating inside the bucket the quantile falls in
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def getSummary(self):
+        return {"count": self.count,
+                "mean": round(self.sum / self.count, 4) if self.count else 0,
+                "p50": round(self.quantile(0.5), 4),
+                "p95": round(self.quantile(0.95), 4),
+                "max": round(self.max, 4)}
+
+    def getSamples(self, name, labels):
+        #Prometheus buckets are cumulative
+        samples = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + [math.inf], self.counts):
+            total += count
+            samples.append((name + "_bucket", dict(labels, le=formatValue(bound)), total))
+        samples.append((name + "_sum", labels, self.sum))
+        samples.append((name + "_count", labels, self.count))
+        return samples
+
+def formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def formatLabels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join('%s="%s"' % (name, value) for name, value in zip(labels, escaped)) + "}"
+
+def formatMetric(name, kind, help, samples):
+    #samples are (name, labels, value), a histogram's have the _bucket/_sum/_count suffixes
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, kind)]
+    for sampleName, labels, value in samples:
+        lines.append("%s%s %s" % (sampleName, formatLabels(labels), formatValue(value)))
+    return "\n".join(lines) + "\n"
+
+class Metrics:
+    #KBB call latencies, retries and 429s by endpoint, plus how long vehicles wait and take.
+    #A batch can keep its own Metrics with the process wide one as parent, everything it records
+    #is recorded by the parent too.
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    VEHICLE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+    def __init__(self, parent=None) -> None:
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.calls = defaultdict(lambda: Histogram(self.LATENCY_BUCKETS)) #(endpoint, status) -> seconds
+        self.retries = defaultdict(int) #(endpoint, status) -> calls made again
+        self.queueWait = defaultdict(lambda: Histogram(self.VEHICLE_BUCKETS)) #engine -> seconds before a worker started the vehicle
+        self.vehicles = defaultdict(lambda: Histogram(self.VEHICLE_BUCKETS)) #engine -> seconds spent valuing the vehicle
+        self.inProgress = defaultdict(int) #engine -> vehicles being valued
+        self.busyWorkers = 0 #Pool threads running a batch's worker or event loop
+
+    def observeCall(self, endpoint, status, seconds):
+        #status is the HTTP status code, or "error" when no response came back
+        with self.lock:
+            self.calls[(endpoint, str(status))].observe(seconds)
+        if self.parent:
+            self.parent.observeCall(endpoint, status, seconds)
+
+    def countRetry(self, endpoint, status):
+        with self.lock:
+            self.retries[(endpoint, str(status))] += 1
+        if self.parent:
+            self.parent.countRetry(endpoint, status)
+
+    def observeQueueWait(self, engine, seconds):
+        with self.lock:
+            self.queueWait[engine].observe(seconds)
+        if self.parent:
+            self.parent.observeQueueWait(engine, seconds)
+
+    @contextmanager
+    def valuing(self, engine):
+        #Wraps valuing one vehicle
+        self.addInProgress(engine, 1)
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.addInProgress(engine, -1)
+            self.observeVehicle(engine, monotonic() - started)
+
+    def addInProgress(self, engine, count):
+        with self.lock:
+            self.inProgress[engine] += count
+        if self.parent:
+            self.parent.addInProgress(engine, count)
+
+    def observeVehicle(self, engine, seconds):
+        with self.lock:
+            self.vehicles[engine].observe(seconds)
+        if self.parent:
+            self.parent.observeVehicle(engine, seconds)
+
+    @contextmanager
+    def working(self):
+        #Wraps a worker thread or event loop for as long as it holds a pool thread
+        with self.lock:
+            self.busyWorkers += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.busyWorkers -= 1
+
+    def getSummary(self):
+        #Per endpoint totals and latencies, for including in a batch response
+        with self.lock:
+            endpoints = {}
+            for (endpoint, status), histogram in sorted(self.calls.items()):
+                summary = endpoints.setdefault(endpoint, {"calls": 0, "retries": 0, "throttled": 0, "errors": 0, "latency": Histogram(self.LATENCY_BUCKETS)})
+                summary["calls"] += histogram.count
+                if status == "429":
+                    summary["throttled"] += histogram.count
+                elif status != "200":
+                    summary["errors"] += histogram.count
+                summary["latency"].add(histogram)
+            for (endpoint, status), retries in self.retries.items():
+                endpoints[endpoint]["retries"] += retries
+            for summary in endpoints.values():
+                summary["latency"] = summary["latency"].getSummary()
+            return {"kbbCalls": endpoints,
+                    "queueSeconds": {engine: histogram.getSummary() for engine, histogram in self.queueWait.items()},
+                    "vehicleSeconds": {engine: histogram.getSummary() for engine, histogram in self.vehicles.items()}}
+
+    def render(self):
+        with self.lock:
+            calls = []
+            throttled = []
+            for (endpoint, status), histogram in sorted(self.calls.items()):
+                calls += histogram.getSamples("kbb_request_duration_seconds", {"endpoint": endpoint, "status": status})
+                if status == "429":
+                    throttled.append(("kbb_throttled_total", {"endpoint": endpoint}, histogram.count))
+            retries = [("kbb_retries_total", {"endpoint": endpoint, "status": status}, count) for (endpoint, status), count in sorted(self.retries.items())]
+            queueWait = []
+            for engine, histogram in sorted(self.queueWait.items()):
+                queueWait += histogram.getSamples("kbb_vehicle_queue_seconds", {"engine": engine})
+            vehicles = []
+            for engine, histogram in sorted(self.vehicles.items()):
+                vehicles += histogram.getSamples("kbb_vehicle_duration_seconds", {"engine": engine})
+            inProgress = [("kbb_vehicles_in_progress", {"engine": engine}, count) for engine, count in sorted(self.inProgress.items())]
+            busyWorkers = self.busyWorkers
+        return (formatMetric("kbb_request_duration_seconds", "histogram", "KBB API call latency by endpoint and status code, every attempt counts.", calls)
+                + formatMetric("kbb_retries_total", "counter", "KBB API calls made again after the status code they got.", retries)
+                + formatMetric("kbb_throttled_total", "counter", "KBB API calls answered with a 429.", throttled)
+                + formatMetric("kbb_vehicle_queue_seconds", "histogram", "Time from a batch being accepted to a worker starting on the vehicle.", queueWait)
+                + formatMetric("kbb_vehicle_duration_seconds", "histogram", "Time spent valuing a vehicle.", vehicles)
+                + formatMetric("kbb_vehicles_in_progress", "gauge", "Vehicles being valued right now.", inProgress)
+                + formatMetric("kbb_busy_workers", "gauge", "Worker pool threads running a batch.", [("kbb_busy_workers", {}, busyWorkers)]))
@@ -0,0 +1,65 @@
+from functools import lru_cache
+
+class NameNormalizer:
+    #Kbb's trim and option name tables compiled once into upper case keyed lookups, with the
+    #most recently converted names memoized. lru_cache is thread safe so one instance is shared
+    #by every Kbb instance in the process.
+    DEFAULT_CACHE_SIZE = 4096 #Names of each kind remembered
+
+    def __init__(self, trimConversion, trimIgnore, optionConversion, optionIgnore, optionRemove, cacheSize=DEFAULT_CACHE_SIZE) -> None:
+        #The first entry wins when two keys only differ by case, like the linear scan did
+        self.trimConversion = {}
+        for acro, word in trimConversion.items():
+            self.trimConversion.setdefault(acro.upper(), word)
+        self.trimIgnore = frozenset(trimIgnore) #Upper case words are compared as is, so only all caps entries match
+        self.optionConversion = {}
+        for replace, replacement in optionConversion.items():
+            self.optionConversion.setdefault(replace.upper(), replacement.upper())
+        self.optionIgnore = tuple(blacklist.upper() for blacklist in optionIgnore)
+        self.optionRemove = tuple(optionRemove)
+
+        self.convertTrimName = lru_cache(maxsize=cacheSize)(self.convertTrimName)
+        self.convertOptionName = lru_cache(maxsize=cacheSize)(self.convertOptionName)
+        self.isIgnoredOption = lru_cache(maxsize=cacheSize)(self.isIgnoredOption)
+        self.cleanName = lru_cache(maxsize=cacheSize)(self.cleanName)
+
+    def convertTrimName(self, trimName):
+        convertedTrimName = []
+        for trimWord in trimName.split():
+            if trimWord.upper() in self.trimIgnore:
+                break
+            convertedTrimName.append(self.trimConversion.get(trimWord.upper(), trimWord))
+        return ' '.join(convertedTrimName)
+
+    def convertOptionName(self, optionName):
+        convertedOptionName = []
+        match = False #Never reset, so once a word is converted only words that convert are kept
+        for word in optionName.split():
+            replacement = self.optionConversion.get(word.upper())
+            if replacement is not None:
+                convertedOptionName.append(replacement)
+                match = True
+            elif not match:
+                convertedOptionName.append(word)
+        return " ".join(convertedOptionName)
+
+    def isIgnoredOption(self, option):
+        option = option.upper()
+        return any(blacklist in option for blacklist in self.optionIgnore)
+
+    def filterOptions(self, options):
+        return [option for option in options if not self.isIgnoredOption(option)]
+
+    def cleanName(self, name):
+        for substr in self.optionRemove:
+            name = name.replace(substr, "")
+        return name
+
+    def getStats(self):
+        stats = [self.convertTrimName.cache_info(), self.convertOptionName.cache_info(), self.isIgnoredOption.cache_info(), self.cleanName.cache_info()]
+        hits = sum(stat.hits for stat in stats)
+        misses = sum(stat.misses for stat in stats)
+        return {"hits": hits,
+                "misses": misses,
+                "hitRate": round(hits / (hits + misses), 4) if hits + misses else 0,
+                "size": sum(stat.currsize for stat in stats)}
@@ -0,0 +1,44 @@
+class OptionIndex:
+    #A vehicle's KBB option names split into upper case words, with each word mapped to the options
+    #that have it, so dealer options can be narrowed down with set intersections instead of
+    #re-splitting every KBB option name for every dealer option word
+    EMPTY = frozenset()
+
+    def __init__(self, optionNames) -> None:
+        postings = {}
+        self.wordCounts = []
+        for index, optionName in enumerate(optionNames):
+            self.wordCounts.append(len(optionName.split()))
+            for word in optionName.replace(",", "").upper().split():
+                postings.setdefault(word, set()).add(index)
+        self.postings = {word: frozenset(indexes) for word, indexes in postings.items()}
+        self.all = frozenset(range(len(self.wordCounts)))
+
+    def find(self, word):
+        #Indexes of the options with word in their name, word has to be upper case
+        return self.postings.get(word, self.EMPTY)
+
+    def match(self, optionNames, bypassWords, matchPercentage):
+        #Index of the KBB option each dealer option name matches, None if it doesn't match one.
+        #The candidates are narrowed a word at a time, a word no option has is skipped. Once one
+        #option is left it's a match when a bypass word narrowed it down or enough of its words matched.
+        matches = []
+        for optionName in optionNames:
+            match = None
+            matchCount = 0
+            candidates = self.all
+            for optionWord in optionName.split():
+                optionWord = optionWord.upper()
+                narrowed = candidates & self.find(optionWord)
+                if len(narrowed) == 1:
+                    matchCount += 1
+                    candidates = narrowed
+                    index = next(iter(narrowed))
+                    if optionWord in bypassWords or matchCount / self.wordCounts[index] > matchPercentage:
+                        match = index
+                        break
+                elif narrowed:
+                    matchCount += 1
+                    candidates = narrowed
+            matches.append(match)
+        return matches
@@ -0,0 +1,75 @@
+import threading
+from time import monotonic, sleep
+
+class RateLimiter:
+    DEFAULT_RATE = 10 #Requests per second allowed across the process
+    DEFAULT_BURST = 10 #Requests that can be sent at once after being idle
+    MIN_RATE = 0.5 #Never slow down past this many requests per second
+    RECOVERY = 0.1 #Requests per second added back after every successful call
+    BACKOFF = 1 #Seconds everyone waits after a 429 without a Retry-After header
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST) -> None:
+        self.lock = threading.Lock()
+        self.configuredRate = rate #KBB_RATE_LIMIT, the rate is never raised past it whatever KBB allows
+        self.maxRate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.pausedUntil = 0
+        self.throttled = 0
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.configuredRate = rate
+            self.maxRate = rate
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        #Takes a token and returns the seconds the caller has to wait before using it.
+        #Tokens can go negative so callers queue up behind each other instead of all waking at once.
+        with self.lock:
+            now = monotonic()
+            self.refill(now)
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.pausedUntil - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    def update(self, statusCode, headers):
+        #Learn from the X-RateLimit-* headers and slow every thread down on a 429
+        with self.lock:
+            now = monotonic()
+            self.refill(now)
+            if "X-RateLimit-Limit-Second" in headers:
+                self.maxRate = max(min(float(headers["X-RateLimit-Limit-Second"]), self.configuredRate), self.MIN_RATE)
+                self.rate = min(self.rate, self.maxRate)
+                self.burst = min(self.burst, self.maxRate)
+            if headers.get("X-RateLimit-Remaining-Second") == "0":
+                self.tokens = min(self.tokens, 0)
+            if statusCode == 429:
+                self.throttled += 1
+                self.rate = max(self.rate / 2, self.MIN_RATE)
+                self.tokens = min(self.tokens, 0)
+                retryAfter = headers.get("Retry-After")
+                pause = float(retryAfter) if retryAfter and retryAfter.isdigit() else self.BACKOFF
+                self.pausedUntil = max(self.pausedUntil, now + pause)
+            elif statusCode == 200:
+                self.rate = min(self.rate + self.RECOVERY, self.maxRate)
+
+    def getStats(self):
+        with self.lock:
+            return {"rate": round(self.rate, 2),
+                    "maxRate": self.maxRate,
+                    "burst": self.burst,
+                    "throttled": self.throttled}
@@ -0,0 +1,89 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from time import time
+
+from kbbcache import CatalogCache
+
+class ResolutionStore:
+    #Resolved vehicles (KBB vehicle, trims and configured options) kept between runs, so pricing a
+    #vehicle again only needs its vehicle/values call. Entries are keyed by VIN, or by ID for vehicles
+    #without one, and only reused while the inputs they were resolved from hash the same.
+    #Like VinCache, the temp dir default doesn't outlive the container, point path at a mounted volume.
+    DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "kbb_resolutions.sqlite3")
+    DEFAULT_TTL = 30 * 86400 #Seconds before a vehicle is resolved again, KBB's catalog changes slowly
+    DEFAULT_MEMORY_SIZE = 4096 #Resolutions kept in memory in front of the SQLite file
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL, memorySize=DEFAULT_MEMORY_SIZE) -> None:
+        self.path = path #None keeps resolutions in memory only
+        self.ttl = ttl
+        self.memory = CatalogCache(ttl=ttl, maxSize=memorySize) #key -> (inputHash, created, resolution)
+        self.local = threading.local() #sqlite connections can't be shared between threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0
+
+    def connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS resolutions (key TEXT PRIMARY KEY, input_hash TEXT NOT NULL, resolution TEXT NOT NULL, created REAL NOT NULL)")
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def read(self, key):
+        if not self.path:
+            return None
+        try:
+            row = self.connect().execute("SELECT input_hash, created, resolution FROM resolutions WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        return (row[0], row[1], json.loads(row[2])) if row else None
+
+    def write(self, key, entry):
+        if not self.path:
+            return
+        try:
+            connection = self.connect()
+            connection.execute("INSERT OR REPLACE INTO resolutions (key, input_hash, resolution, created) VALUES (?, ?, ?, ?)",
+                               (key, entry[0], json.dumps(entry[2]), entry[1]))
+            connection.commit()
+        except sqlite3.Error:
+            pass #The store is best effort, the vehicle is still valued
+
+    def get(self, key, inputHash):
+        #The resolution saved for key, None if there isn't one, it expired or the inputs changed
+        with self.memory.lock:
+            found, entry = self.memory.lookup(key)
+        if not found:
+            entry = self.read(key)
+            if entry is not None:
+                self.memory.put(key, entry)
+        hit = entry is not None and entry[0] == inputHash and time() - entry[1] < self.ttl
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry[2] if hit else None
+
+    def put(self, key, inputHash, resolution):
+        entry = (inputHash, time(), resolution)
+        self.memory.put(key, entry)
+        self.write(key, entry)
+        with self.lock:
+            self.saved += 1
+
+    def getStats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hitRate": round(self.hits / lookups, 4) if lookups else 0,
+                    "size": len(self.memory.entries),
+                    "saved": self.saved}
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+from collections import Counter
+
+class Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    #Identical calls made at the same time share one upstream call. The first caller makes it,
+    #the others wait for it and get the same result, or the same exception.
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights = {} #key -> Flight of the thread making the call
+        self.asyncFlights = {} #key -> Future of the coroutine making the call
+        self.saved = Counter() #Calls that were shared instead of made, by name
+
+    def do(self, key, name, call):
+        #Returns (result, shared), shared is True when another thread made the call
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+            else:
+                self.saved[name] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = call()
+            return flight.result, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    async def doAsync(self, key, name, call):
+        #Coroutine version of do, only calls made from the same event loop are shared
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            flight = self.asyncFlights.get(key)
+            leader = flight is None
+            if leader:
+                flight = loop.create_future()
+                self.asyncFlights[key] = flight
+            elif flight.get_loop() is loop:
+                self.saved[name] += 1
+        if not leader:
+            if flight.get_loop() is not loop:
+                return await call(), False
+            try:
+                return await asyncio.shield(flight), True
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+                #The coroutine making the call was cancelled rather than this one, make it here
+                return await call(), False
+        try:
+            result = await call()
+            flight.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            #Nobody may be waiting, don't let asyncio warn that the exception was never retrieved
+            flight.exception()
+            raise
+        finally:
+            with self.lock:
+                del self.asyncFlights[key]
+
+    def getStats(self):
+        with self.lock:
+            return {"saved": sum(self.saved.values()),
+                    "byEndpoint": dict(self.saved)}
@@ -141,6 +141,13 @@ def test(c):  # noqa: ANN001, ANN201
         c.run("pytest test/test_app.py")
 
 
+@task(pre=[require_venv])
+def benchmark(c):  # noqa: ANN001, ANN201
+    """Run the benchmark suite against a local fake KBB server, results go to benchmarks/results"""
+    with c.prefix(venv):
+        c.run("python -m benchmarks.suite")
+
+
 @task(pre=[require_venv_test])
 def system_test(c):  # noqa: ANN001, ANN201
     """Run system tests"""
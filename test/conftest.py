@@ -12,11 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import Callable, Iterator
+
 import flask
 from flask.testing import FlaskClient
 import pytest
 
 from app import app as flask_app
+from fakekbb import FakeKbb
+from kbb import Kbb
+from kbbcache import CatalogCache, MakeCatalog, OptionsCache, VinCache
+from ratelimiter import RateLimiter
 
 
 @pytest.fixture
@@ -27,3 +33,26 @@ def app() -> None:
 @pytest.fixture
 def client(app: flask.app.Flask) -> FlaskClient:
     return app.test_client()
+
+
+@pytest.fixture
+def clearCaches(monkeypatch: pytest.MonkeyPatch) -> Callable[[], None]:
+    """Gives Kbb empty class-level caches and no resolution store, call it again for another cold start"""
+    def clear() -> None:
+        for name, cache in (("makeCatalog", MakeCatalog()), ("modelCatalog", CatalogCache()), ("trimCatalog", CatalogCache()),
+                            ("vinCache", VinCache(None)), ("optionsCache", OptionsCache()), ("valueCache", CatalogCache()),
+                            ("resolutionStore", None)):
+            monkeypatch.setattr(Kbb, name, cache)
+    clear()
+    return clear
+
+
+@pytest.fixture
+def fake(monkeypatch: pytest.MonkeyPatch, clearCaches: Callable[[], None]) -> Iterator[FakeKbb]:
+    """A local FakeKbb server every Kbb call goes to, with cold caches and no rate limiting to speak of"""
+    fake = FakeKbb()
+    monkeypatch.setattr(Kbb, "KBB_API_ENDPOINT", fake.start())
+    monkeypatch.setattr(Kbb, "rateLimiter", RateLimiter(rate=1000, burst=1000))
+    monkeypatch.setenv("kbb_api_key", "key")
+    yield fake
+    fake.stop()
@@ -12,15 +12,135 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
+import os
+import signal
+import tempfile
+import threading
+
 import flask
 from flask.testing import FlaskClient
+import pytest
+
+import app as appModule
+from fakekbb import FakeKbb
+from jobstore import JobStore, MemoryJobStore
+from kbb import Kbb
+
+CSV = """ID,VIN,Year,MakeName,ModelName,BodyStyle,OptionsDescription,Mileage
+1,5TFCZ5AN1KX000001,2019,Toyota,Tacoma,SR5 Double Cab,Moonroof,"40,000"
+1,5TFCZ5AN1KX000001,2019,Toyota,Tacoma,SR5 Double Cab,JBL Audio,"40,000"
+2,5TFCZ5AN1KX000002,2019,Toyota,Tacoma,SR5 Double Cab,,"12,345"
+3,5TFCZ5AN1KX000003,2019,Toyota,Tacoma,Limited Double Cab,Navi System,"61,000"
+"""
 
 
 def test_get_index(app: flask.app.Flask, client: FlaskClient) -> None:
     res = client.get("/")
-    assert res.status_code == 200
+    assert res.status_code == 405
 
 
 def test_post_index(app: flask.app.Flask, client: FlaskClient) -> None:
     res = client.post("/")
-    assert res.status_code == 405
+    assert res.status_code == 200
+    assert res.get_json()["vehicleCount"] == 0
+    assert res.get_json()["vehicles"] == {}
+
+
+def test_stream_sends_a_line_per_vehicle_then_the_summary(client: FlaskClient, fake: FakeKbb, monkeypatch: pytest.MonkeyPatch) -> None:
+    batches = []
+    startWork = appModule.startWork
+    monkeypatch.setattr(appModule, "startWork", lambda batch: batches.append(batch) or startWork(batch))
+
+    res = client.post("/?stream=Y&threads=2", data=CSV, content_type="text/csv")
+    lines = [json.loads(line) for line in res.data.decode().splitlines()]
+
+    assert res.mimetype == "application/x-ndjson"
+    assert len(lines) == 4
+    assert sorted(line["key"] for line in lines[:3]) == ["5TFCZ5AN1KX000001", "5TFCZ5AN1KX000002", "5TFCZ5AN1KX000003"]
+    assert all("prices" in line for line in lines[:3])
+    assert lines[3]["vehicleCount"] == 3 and lines[3]["processed"] == 3
+    assert batches[0].records == {}
+
+
+def vehicles(count: int) -> dict:
+    return {"vehicles": [{"key": str(i), "year": 2019, "make": "Toyota", "model": "Tacoma", "mileage": 40000 + i} for i in range(count)]}
+
+
+def test_batches_share_the_worker_pool(client: FlaskClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(appModule, "jobStore", MemoryJobStore())
+    threads = set()
+    def job(batch, record):
+        threads.add(threading.current_thread().name)
+        batch.startVehicle()
+        batch.finishVehicle(record, {}, float("inf"))
+    monkeypatch.setattr(appModule, "job", job)
+    workers = []
+    startWork = appModule.startWork
+    monkeypatch.setattr(appModule, "startWork", lambda batch: workers.append(startWork(batch)) or workers[-1])
+
+    #Two overlapping jobs asking for more threads than the pool has only get MAX_WORKERS each, from the same pool
+    assert client.post("/jobs?jobKey=pool-1&validation=1&threads=1000", json=vehicles(50)).status_code == 202
+    assert client.post("/jobs?jobKey=pool-2&validation=1&threads=1000", json=vehicles(50)).status_code == 202
+    assert [len(batchWorkers) for batchWorkers in workers] == [appModule.MAX_WORKERS, appModule.MAX_WORKERS]
+    wait(workers[0] + workers[1], timeout=10)
+
+    assert all(name.startswith("worker") for name in threads)
+    assert len(threads) <= appModule.MAX_WORKERS
+    assert [appModule.jobStore.getJob(jobId)["processed"] for jobId in ("pool-1", "pool-2")] == [50, 50]
+    #Every worker and trim pricing thread can keep its own KBB connection
+    assert Kbb.session.poolSize >= appModule.MAX_WORKERS + Kbb.KBB_TRIM_WORKERS
+
+
+def test_sigterm_drains_the_workers_and_refuses_new_batches(client: FlaskClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    #A pool of the test's own, the handler shuts it down
+    monkeypatch.setattr(appModule, "workerPool", ThreadPoolExecutor(max_workers=2, thread_name_prefix="worker"))
+    monkeypatch.setattr(appModule, "draining", threading.Event())
+    monkeypatch.setattr(appModule, "jobStore", MemoryJobStore())
+    started = threading.Event()
+    release = threading.Event()
+    def job(batch, record):
+        batch.startVehicle()
+        started.set()
+        release.wait(10)
+        batch.finishVehicle(record, {}, float("inf"))
+    monkeypatch.setattr(appModule, "job", job)
+
+    assert client.post("/jobs?jobKey=drain&validation=1&threads=1", json=vehicles(4)).status_code == 202
+    assert started.wait(10)
+
+    exits = []
+    def shutdown():
+        try:
+            appModule.shutdown_handler(signal.SIGTERM, None)
+        except SystemExit as e:
+            exits.append(e.code)
+    handler = threading.Thread(target=shutdown)
+    handler.start()
+    assert appModule.draining.wait(10)
+
+    #New batches are refused while the one in flight finishes
+    for path in ("/?validation=1", "/jobs?validation=1"):
+        res = client.post(path, json=vehicles(1))
+        assert res.status_code == 503
+        assert res.get_json()["errors"]
+    assert handler.is_alive()
+
+    release.set()
+    handler.join(10)
+    assert exits == [0]
+    job = appModule.jobStore.getJob("drain")
+    assert job["status"] == JobStore.STOPPED
+    assert (job["vehicleCount"], job["processed"]) == (4, 1)
+    assert list(appModule.jobStore.getResults("drain", 0, 10)) == ["0"]
+
+
+def test_warns_about_stores_in_the_temp_dir(monkeypatch: pytest.MonkeyPatch) -> None:
+    warnings = []
+    monkeypatch.setattr(appModule.logger, "warning", warnings.append)
+
+    assert appModule.warnIfNotPersistent("KBB_JOB_STORE", os.path.join(tempfile.gettempdir(), "kbb_jobs.sqlite3"))
+    assert not appModule.warnIfNotPersistent("KBB_JOB_STORE", "/mnt/kbb/kbb_jobs.sqlite3")
+    assert not appModule.warnIfNotPersistent("KBB_VIN_CACHE_PATH", "")
+    assert len(warnings) == 1 and "KBB_JOB_STORE" in warnings[0]
@@ -0,0 +1,44 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from batchjob import BatchJob
+
+
+def test_batches_keep_their_own_counters() -> None:
+    first = BatchJob({"A": {"key": "A"}, "B": {"key": "B"}}, pricing=False)
+    second = BatchJob({"C": {"key": "C"}})
+
+    first.startVehicle()
+    first.saveReport({"key": "A"}, {"prices": [{"configuredValue": 1}], "numCallsMade": 4, "usedLowestPricedTrim": True})
+    first.finishVehicle({"key": "A"}, {}, 900)
+    first.startVehicle()
+    first.finishVehicle({"key": "B"}, {"errors": ["Could not determine KBB make."]}, 899)
+
+    assert first.getSummary() == {"vehicleCount": 2, "processed": 2, "priced": 1, "errors": 1,
+                                  "totalCallsMade": 4, "remainingCalls": 899, "usedLowestPricedTrim": 1,
+                                  "resumed": 0, "deferred": 0, "failedTemporarily": 0, "resolvedFromStore": 0, "droppedOptionRows": 0}
+    assert "prices" not in first.records["A"]
+    assert first.records["B"]["errors"] == ["Could not determine KBB make."]
+    assert second.getSummary()["processed"] == 0
+
+
+def test_plan_starts_every_group_before_repeats() -> None:
+    records = {"1": {"key": "1", "vin": "5TFCZ5AN1KX000001", "trim": "SR5"},
+               "2": {"key": "2", "vin": "5TFCZ5AN7KX000002", "trim": "SR5"},
+               "3": {"key": "3", "year": 2019, "make": "Toyota", "model": "Tacoma", "trim": "SR5"},
+               "4": {"key": "4", "year": 2019, "make": "Toyota", "model": "Tacoma", "trim": "SR5"},
+               "5": {"key": "5", "vin": "5TFCZ5AN1KX000003", "trim": "TRD"}}
+
+    assert [key for key, record in BatchJob(records).plan()] == ["1", "3", "5", "2", "4"]
+    assert [key for key, record in BatchJob(records, grouping=False).plan()] == ["1", "2", "3", "4", "5"]
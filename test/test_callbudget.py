@@ -0,0 +1,113 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from time import sleep
+
+import pytest
+
+from batchjob import BatchJob
+from callbudget import BudgetUsedUpError, CallBudget
+from kbb import Kbb
+from singleflight import SingleFlight
+
+
+def test_vehicles_are_deferred_once_the_budget_cannot_cover_them() -> None:
+    budget = CallBudget(20, estimate=8)
+    first = budget.admit("vin")
+    assert budget.getStats()["held"] == 8
+    for i in range(3):
+        first.spend()
+    first.release()
+    #The estimate is now what the finished vehicle cost, the unspent calls went back to the budget
+    assert budget.getStats() == {"budget": 20, "spent": 3, "held": 0, "estimates": {"vin": 3}}
+
+    #While vehicles are in flight a costliest vehicle's worth of calls stays unheld for one to overrun into
+    holds = []
+    while True:
+        hold, wait = budget.tryAdmit("vin")
+        if hold is None:
+            break
+        holds.append(hold)
+    assert len(holds) == 4 and wait
+    assert budget.getFree() == 5
+    for hold in holds:
+        hold.release()
+    assert budget.getFree() == 17
+
+
+def test_spending_past_the_budget_fails_and_kbb_quota_caps_it() -> None:
+    budget = CallBudget(10, estimate=2)
+    hold = budget.admit("name")
+    hold.cap(5)
+    assert budget.getStats()["budget"] == 5
+    for i in range(5):
+        hold.spend()
+    with pytest.raises(Exception, match="call budget of 5"):
+        hold.spend()
+    hold.release()
+    assert budget.admit("name") is None
+
+
+def test_deferred_vehicles_are_reported_and_not_checkpointed() -> None:
+    class Store:
+        saved = []
+
+        def saveResult(self, jobId, key, vehicle, summary):
+            self.saved.append(key)
+
+    batch = BatchJob({"A": {"key": "A", "vin": "5TFCZ5ANXKX000001"}, "B": {"key": "B"}}, callBudget=1)
+    batch.store = Store()
+    hold = batch.admitVehicle(batch.records["A"])
+    hold.spend()
+    hold.release()
+    assert batch.admitVehicle(batch.records["B"]) is None
+    batch.vehicleDone(batch.records["B"])
+    assert batch.deferred == ["B"]
+    assert batch.getSummary()["deferred"] == 1
+    assert Store.saved == []
+
+
+def test_shared_calls_are_paid_by_the_vehicle_that_makes_them(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Kbb, "singleFlight", SingleFlight())
+    answered = threading.Event()
+    def fetchResponse(self, requestType, url, params, data, retries=99):
+        answered.wait(5)
+        return 200, {"items": []}, b"", {}
+    monkeypatch.setattr(Kbb, "fetchResponse", fetchResponse)
+    small = CallBudget(1, estimate=1)
+    large = CallBudget(10, estimate=5)
+    leader = Kbb("key")
+    leader.budget = small.admit("name")
+    follower = Kbb("key")
+    follower.budget = large.admit("name")
+
+    calls = [threading.Thread(target=kbb.sendRequest, args=("GET", "vehicle/makes", {}, {})) for kbb in (leader, follower)]
+    #The follower joins the leader's call while it is still waiting on KBB
+    calls[0].start()
+    while not Kbb.singleFlight.flights:
+        sleep(0.001)
+    calls[1].start()
+    while not Kbb.singleFlight.saved:
+        sleep(0.001)
+    answered.set()
+    for call in calls:
+        call.join()
+    assert (small.getStats()["spent"], large.getStats()["spent"]) == (1, 0)
+
+    #The small budget is used up, only its own vehicle is told so
+    with pytest.raises(BudgetUsedUpError):
+        leader.sendRequest("GET", "vehicle/makes", {}, {})
+    assert follower.sendRequest("GET", "vehicle/makes", {}, {}) == {"items": []}
+    assert large.getStats()["spent"] == 1
@@ -0,0 +1,104 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import pathlib
+import threading
+import urllib.error
+import urllib.request
+from typing import Callable
+
+import pytest
+
+from asynckbb import AsyncKbb, createSession
+from fakekbb import FakeKbb
+from kbb import Kbb
+from resolutionstore import ResolutionStore
+
+
+def test_kbb_values_vehicles_against_fake(fake: FakeKbb) -> None:
+    byName = Kbb("key").getVehicleValue("1", "", 2019, "Toyota", "Tacoma", "Tacoma SR5 Double Cab", 40000, "96819", ["Moonroof"])
+    byVin = Kbb("key").getVehicleValue("2", "5TFCZ5AN1KX000001", 2019, "Toyota", "Tacoma", "Tacoma SR5", 40000, "96819", [])
+
+    assert byName["errors"] == [] and byName["prices"][0]["priceTypeId"] == 2
+    assert byVin["errors"] == [] and byVin["prices"]
+    assert fake.getStats()["calls"]["vehicle/vin"] == 1
+    assert fake.getStats()["remainingDay"] < FakeKbb.DAILY_LIMIT
+
+
+def test_async_engine_matches_threads(fake: FakeKbb, clearCaches: Callable[[], None]) -> None:
+    vehicles = [("1", "5TFCZ5AN1KX000001", 2019, "Toyota", "Tacoma", "Tacoma SR5", 40000, "96819", ["Moonroof"]),
+                ("2", "", 2019, "Toyota", "Tacoma", "SR5 Double Cab", 52000, "96819", ["JBL Audio"]),
+                ("3", "", 2019, "Toyota", "Tacoma", "Tacoma Platinum", 61000, "96819", []),
+                ("4", "", 2019, "Yugo", "GV", "GV Base", 90000, "96819", [])]
+    threads = [Kbb("key").getVehicleValue(*vehicle) for vehicle in vehicles]
+
+    #Both engines start from empty caches so the async one makes its own KBB calls
+    clearCaches()
+    async def valueVehicles() -> list:
+        async with createSession(len(vehicles)) as session:
+            return await asyncio.gather(*(AsyncKbb("key", session).getVehicleValue(*vehicle) for vehicle in vehicles))
+    engines = asyncio.run(valueVehicles())
+
+    assert [value["usedLowestPricedTrim"] for value in threads] == [False, False, True, False]
+    assert threads[3]["errors"] and threads[3]["prices"] is None
+    for byThreads, byAsync in zip(threads, engines):
+        assert byAsync["errors"] == byThreads["errors"]
+        assert byAsync["prices"] == byThreads["prices"]
+        assert byAsync["usedLowestPricedTrim"] == byThreads["usedLowestPricedTrim"]
+
+
+def test_async_engine_keeps_sqlite_off_the_event_loop(fake: FakeKbb, monkeypatch: pytest.MonkeyPatch) -> None:
+    lookups = []
+    class Store(ResolutionStore):
+        def get(self, key: str, inputHash: str) -> None:
+            lookups.append(threading.get_ident())
+            return super().get(key, inputHash)
+    monkeypatch.setattr(Kbb, "resolutionStore", Store(None))
+    async def valueVehicle() -> tuple:
+        async with createSession(1) as session:
+            return threading.get_ident(), await AsyncKbb("key", session).getVehicleValue("1", "5TFCZ5AN1KX000001", 2019, "Toyota", "Tacoma", "Tacoma SR5", 40000, "96819", [])
+    loop, value = asyncio.run(valueVehicle())
+
+    assert value["prices"]
+    assert lookups and loop not in lookups
+
+
+def test_record_then_replay(fake: FakeKbb, tmp_path: pathlib.Path) -> None:
+    recorder = FakeKbb(str(tmp_path), mode="record", upstream=Kbb.KBB_API_ENDPOINT)
+    url = recorder.start() + "vehicle/vehicleoptions?vehicleId=101&api_key=secret"
+    recorded = json.load(urllib.request.urlopen(url))
+    recorder.stop()
+    assert "secret" not in "".join(path.read_text() for path in tmp_path.iterdir())
+
+    replayer = FakeKbb(str(tmp_path), strict=True)
+    base = replayer.start()
+    assert json.load(urllib.request.urlopen(base + "vehicle/vehicleoptions?vehicleId=101&api_key=other")) == recorded
+    with pytest.raises(urllib.error.HTTPError) as missing:
+        urllib.request.urlopen(base + "vehicle/vehicleoptions?vehicleId=102")
+    replayer.stop()
+    assert missing.value.code == 404
+
+
+def test_injected_throttling_sends_rate_limit_headers() -> None:
+    fake = FakeKbb(throttle=1, dailyLimit=10)
+    url = fake.start()
+    with pytest.raises(urllib.error.HTTPError) as throttled:
+        urllib.request.urlopen(url + "vehicle/makes")
+    fake.stop()
+
+    assert throttled.value.code == 429
+    assert throttled.value.headers["X-RateLimit-Remaining-Day"] == "10"
+    assert throttled.value.headers["Retry-After"] == "1"
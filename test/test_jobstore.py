@@ -0,0 +1,132 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+from time import sleep
+
+from flask.testing import FlaskClient
+import pytest
+
+import app as appModule
+from batchjob import BatchJob
+from fakekbb import FakeKbb
+from jobstore import JobStore, MemoryJobStore, SqliteJobStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request: pytest.FixtureRequest, tmp_path: pathlib.Path) -> JobStore:
+    if request.param == "memory":
+        return MemoryJobStore()
+    return SqliteJobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_job_progress_and_paged_results(store: JobStore) -> None:
+    batch = BatchJob({"A": {"key": "A"}, "B": {"key": "B"}, "C": {"key": "C"}})
+    batch.store = store
+    batch.jobId = "job-1"
+    store.createJob(batch.jobId, batch.getSummary())
+
+    for key in ("B", "A", "C"):
+        batch.startVehicle()
+        batch.finishVehicle({"key": key}, {}, 900)
+        batch.vehicleDone({"key": key})
+
+    job = store.getJob("job-1")
+    assert job["status"] == JobStore.RUNNING
+    assert job["processed"] == 3
+    assert batch.records == {}
+
+    store.finishJob("job-1", batch.getSummary())
+    assert store.getJob("job-1")["status"] == JobStore.DONE
+    assert list(store.getResults("job-1", 0, 2)) == ["B", "A"]
+    assert store.getResults("job-1", 2, 2) == {"C": {"key": "C"}}
+    assert store.getJob("missing") is None
+
+
+def test_resubmitted_job_skips_finished_vehicles(store: JobStore) -> None:
+    first = BatchJob({"A": {"key": "A"}, "B": {"key": "B"}})
+    first.store = store
+    first.jobId = "job-2"
+    store.createJob("job-2", first.getSummary())
+    first.startVehicle()
+    first.vehicleDone({"key": "A"})
+    assert not first.isFinished()
+
+    second = BatchJob({"A": {"key": "A"}, "B": {"key": "B"}})
+    second.resume(store.getResultKeys("job-2"))
+    store.createJob("job-2", second.getSummary())
+
+    assert list(second.records) == ["B"]
+    assert second.getSummary()["resumed"] == 1
+    assert store.getJob("job-2")["status"] == JobStore.RUNNING
+    assert store.getResults("job-2", 0, 10) == {"A": {"key": "A"}}
+
+
+def test_resumed_job_keeps_its_counts_and_retries_temporary_failures(store: JobStore) -> None:
+    records = lambda: {"A": {"key": "A"}, "B": {"key": "B"}, "C": {"key": "C"}}
+    first = BatchJob(records())
+    first.store = store
+    first.jobId = "job-3"
+    store.createJob("job-3", first.getSummary())
+    reports = {"A": ({"errors": [], "prices": [{"priceTypeId": 2}], "numCallsMade": 4, "usedLowestPricedTrim": True}, False),
+               "B": ({"errors": ["Could not determine KBB make."], "numCallsMade": 1}, False),
+               "C": ({"errors": ["The KBB API responded with a 429 status code: "]}, True)}
+    for key, (report, failedTemporarily) in reports.items():
+        first.startVehicle()
+        first.saveReport({"key": key}, report)
+        first.finishVehicle({"key": key}, report, 900, failedTemporarily)
+        first.vehicleDone({"key": key})
+    assert first.getSummary()["failedTemporarily"] == 1
+
+    second = BatchJob(records())
+    second.resume(store.getResultKeys("job-3"), store.getResults("job-3", 0, 10).values())
+    summary = second.getSummary()
+
+    assert list(second.records) == ["C"]
+    assert (summary["resumed"], summary["processed"], summary["priced"], summary["errors"]) == (2, 2, 1, 1)
+    assert (summary["totalCallsMade"], summary["usedLowestPricedTrim"]) == (5, 1)
+
+
+def test_store_must_implement_every_method() -> None:
+    class Partial(JobStore):
+        def getJob(self, jobId):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_jobs_api_submit_poll_and_page(client: FlaskClient, fake: FakeKbb, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(appModule, "jobStore", MemoryJobStore())
+    vehicles = [{"key": str(i), "year": 2019, "make": "Toyota", "model": "Tacoma", "trim": "SR5 Double Cab", "mileage": 40000 + i} for i in range(5)]
+
+    res = client.post("/jobs?jobKey=api-1&validation=1&threads=2", json={"vehicles": vehicles})
+    assert res.status_code == 202
+    assert res.get_json() == {"jobId": "api-1", "status": JobStore.RUNNING}
+
+    for i in range(500):
+        job = client.get("/jobs/api-1").get_json()
+        if job["status"] != JobStore.RUNNING:
+            break
+        sleep(0.01)
+    assert job["status"] == JobStore.DONE
+    assert (job["vehicleCount"], job["processed"], job["priced"]) == (5, 5, 5)
+
+    pages = [client.get("/jobs/api-1/results?pageSize=2&page=" + str(page)).get_json() for page in (1, 2, 3, 4)]
+    assert [len(page["vehicles"]) for page in pages] == [2, 2, 1, 0]
+    assert sorted(key for page in pages for key in page["vehicles"]) == ["0", "1", "2", "3", "4"]
+    assert all("prices" in vehicle for page in pages for vehicle in page["vehicles"].values())
+
+    assert client.get("/jobs/missing").status_code == 404
+    assert client.get("/jobs/missing/results").status_code == 404
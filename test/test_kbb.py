@@ -0,0 +1,93 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import Dict, List
+
+import pytest
+
+from kbb import Kbb
+from kbbcache import CatalogCache
+from ratelimiter import RateLimiter
+
+
+class FakeResponse:
+    def __init__(self, body: Dict) -> None:
+        self.status_code = 200
+        self.headers = {"X-RateLimit-Remaining-Day": "100"}
+        self.content = json.dumps(body).encode()
+
+    def json(self) -> Dict:
+        return json.loads(self.content)
+
+
+class FakeSession:
+    """Answers vehicle/values with a price derived from the vehicle and mileage sent"""
+
+    def __init__(self, trimPrices: Dict = None) -> None:
+        self.posts: List[Dict] = []
+        self.trimPrices = trimPrices or {}
+
+    def post(self, url: str, params: Dict = None, json: Dict = None) -> FakeResponse:
+        self.posts.append(json)
+        value = self.trimPrices.get(json["configuration"]["vehicleId"], 30000) - json["mileage"] // 10
+        return FakeResponse({"prices": [{"priceTypeId": 2, "configuredValue": value}]})
+
+
+@pytest.fixture
+def kbb(monkeypatch: pytest.MonkeyPatch) -> Kbb:
+    monkeypatch.setattr(Kbb, "session", FakeSession())
+    monkeypatch.setattr(Kbb, "valueCache", CatalogCache())
+    monkeypatch.setattr(Kbb, "rateLimiter", RateLimiter(rate=1000, burst=1000))
+    return Kbb("key")
+
+
+def test_value_cache_reuses_identical_valuations(kbb: Kbb) -> None:
+    first = kbb.run(kbb.getValueByVehicleId(1, 40000, "96819", [3, 2]))
+    assert not kbb.valueFromCache
+    second = kbb.run(kbb.getValueByVehicleId(1, 40000, "96819", [2, 3]))
+    assert kbb.valueFromCache
+    assert first == second
+    assert len(kbb.session.posts) == 1
+
+    kbb.run(kbb.getValueByVehicleId(1, 40001, "96819", [2, 3]))
+    assert not kbb.valueFromCache
+
+
+def test_value_cache_mileage_buckets(kbb: Kbb) -> None:
+    kbb.mileageBucket = 1000
+    kbb.run(kbb.getValueByVehicleId(1, 40120, "96819", []))
+    kbb.run(kbb.getValueByVehicleId(1, 39880, "96819", []))
+    assert kbb.valueFromCache
+    assert [post["mileage"] for post in kbb.session.posts] == [40000]
+
+
+def test_lowest_priced_trim_breaks_ties_by_trim_order(kbb: Kbb) -> None:
+    kbb.session.trimPrices = {1: 25000, 2: 21000, 3: 21000, 4: 23000}
+    kbb.trims = [{"vehicleId": vehicleId} for vehicleId in (1, 2, 3, 4)]
+    assert kbb.run(kbb.getVehicleByLowestPricedTrim(10000, "96819")) == {"vehicleId": 2}
+    assert kbb.usedLowestPricedTrim
+    assert kbb.callsMade == 4
+
+
+def test_lowest_priced_trim_stops_after_a_wave_at_the_stop_price(kbb: Kbb, monkeypatch: pytest.MonkeyPatch) -> None:
+    kbb.session.trimPrices = {1: 25000, 2: 23000, 3: 21000, 4: 20000, 5: 19000}
+    kbb.trims = [{"vehicleId": vehicleId} for vehicleId in (1, 2, 3, 4, 5)]
+    monkeypatch.setattr(Kbb, "KBB_LOWEST_TRIM_WAVE", 2)
+    monkeypatch.setattr(Kbb, "KBB_LOWEST_TRIM_STOP_PRICE", 20500)
+
+    #The second wave has a trim under the stop price, the fifth trim is never priced
+    assert kbb.run(kbb.getVehicleByLowestPricedTrim(10000, "96819")) == {"vehicleId": 4}
+    assert kbb.callsMade == 4
+    assert 5 not in [post["configuration"]["vehicleId"] for post in kbb.session.posts]
@@ -0,0 +1,117 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+import threading
+import time
+
+from kbbcache import CatalogCache, MakeCatalog, OptionsCache, VinCache
+
+MAKES = [{"makeId": 1, "makeName": "Toyota"}, {"makeId": 2, "makeName": "Land Rover"}]
+
+
+def test_make_catalog_fetches_once() -> None:
+    calls = []
+
+    def fetch() -> list:
+        calls.append(1)
+        return MAKES
+
+    catalog = MakeCatalog()
+    assert catalog.getMakeId("toyota", fetch) == 1
+    assert catalog.getMakeId(" LAND  rover ", fetch) == 2
+    assert catalog.getMakeId("Honda", fetch) == 0
+    assert len(calls) == 1
+
+    catalog.refresh()
+    assert catalog.getMakeId("Toyota", fetch) == 1
+    assert len(calls) == 2
+
+
+def test_make_catalog_expires() -> None:
+    calls = []
+
+    def fetch() -> list:
+        calls.append(1)
+        return MAKES
+
+    catalog = MakeCatalog(ttl=0)
+    catalog.getMakeId("Toyota", fetch)
+    catalog.getMakeId("Toyota", fetch)
+    assert len(calls) == 2
+
+
+def test_catalog_cache_single_fetch_for_concurrent_misses() -> None:
+    calls = []
+
+    def fetch() -> dict:
+        calls.append(1)
+        time.sleep(0.05)
+        return {"items": []}
+
+    cache = CatalogCache()
+    threads = [threading.Thread(target=cache.get, args=(("2019", 1), fetch)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert cache.getStats()["hits"] == 7
+    assert cache.getStats()["misses"] == 1
+
+
+def test_catalog_cache_evicts_least_recently_used() -> None:
+    cache = CatalogCache(maxSize=2)
+    cache.get("a", lambda: 1)
+    cache.get("b", lambda: 2)
+    cache.get("a", lambda: 0)
+    cache.get("c", lambda: 3)
+    assert cache.get("a", lambda: 0) == 1
+    assert cache.get("b", lambda: 0) == 0
+
+
+def test_vin_cache_persists_decodes(tmp_path: pathlib.Path) -> None:
+    path = str(tmp_path / "vins.sqlite3")
+    decoded = [{"vehicleId": 1, "trimName": "SR5"}]
+    VinCache(path).get("5tf", lambda: decoded)
+
+    def fail() -> list:
+        raise Exception("VIN decoded twice")
+
+    cache = VinCache(path)
+    assert cache.get("5TF ", fail) == decoded
+    assert cache.getStats()["diskHits"] == 1
+
+
+def test_vin_cache_skips_failed_decodes(tmp_path: pathlib.Path) -> None:
+    cache = VinCache(str(tmp_path / "vins.sqlite3"))
+
+    def fail() -> list:
+        raise Exception("Invalid VIN")
+
+    for i in range(2):
+        try:
+            cache.get("BAD", fail)
+        except Exception:
+            pass
+    assert cache.getStats()["decodes"] == 0
+    assert cache.get("BAD", lambda: []) == []
+
+
+def test_options_cache_hands_out_independent_views() -> None:
+    cache = OptionsCache()
+    first = cache.get(100, lambda: [{"vehicleOptionId": 1, "optionName": "Moon Roof, Power"}])
+    first[0]["optionName"] = "Moon Roof Power"
+    second = cache.get(100, lambda: [])
+    assert second == [{"vehicleOptionId": 1, "optionName": "Moon Roof, Power"}]
@@ -0,0 +1,57 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from fakekbb import FakeKbb
+from kbb import Kbb
+from kbbsession import KbbSession
+
+
+def test_defaults() -> None:
+    session = KbbSession()
+    assert (session.connectTimeout, session.readTimeout) == (KbbSession.DEFAULT_CONNECT_TIMEOUT, KbbSession.DEFAULT_READ_TIMEOUT)
+    assert session.getStats() == {"poolSize": KbbSession.DEFAULT_POOL_SIZE, "requests": 0, "connectionsOpened": 0, "connectionsReused": 0}
+
+    #The pool only grows
+    session.setPoolSize(4)
+    assert session.poolSize == KbbSession.DEFAULT_POOL_SIZE
+    session.setPoolSize(48)
+    assert session.getStats()["poolSize"] == 48
+
+
+def test_connections_are_reused(fake: FakeKbb) -> None:
+    session = KbbSession()
+    for i in range(5):
+        session.get(Kbb.KBB_API_ENDPOINT + "vehicle/makes", params={"api_key": "key"})
+
+    stats = session.getStats()
+    assert (stats["requests"], stats["connectionsOpened"], stats["connectionsReused"]) == (5, 1, 4)
+
+    #Growing the pool keeps counting the connections the old one opened
+    session.setPoolSize(2 * KbbSession.DEFAULT_POOL_SIZE)
+    session.get(Kbb.KBB_API_ENDPOINT + "vehicle/makes", params={"api_key": "key"})
+    assert session.getStats()["connectionsOpened"] == 2
+
+
+def test_timeout_is_reported_as_a_temporary_error(fake: FakeKbb, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Kbb, "session", KbbSession(readTimeout=0.05))
+    fake.latency = 0.5
+
+    kbb = Kbb("key")
+    report = kbb.getVehicleValue("1", "", 2019, "Toyota", "Tacoma", "Tacoma SR5", 40000, "96819", [])
+    assert report["prices"] is None
+    assert len(report["errors"]) == 1 and "timed out" in report["errors"][0]
+    #A later run of the job retries the vehicle
+    assert kbb.failedTemporarily
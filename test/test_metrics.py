@@ -0,0 +1,55 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import flask
+from flask.testing import FlaskClient
+
+from metrics import Metrics
+
+
+def test_batch_metrics_are_counted_by_parent() -> None:
+    process = Metrics()
+    batch = Metrics(process)
+    batch.observeCall("vehicle/values", 429, 0.02)
+    batch.countRetry("vehicle/values", 429)
+    batch.observeCall("vehicle/values", 200, 0.04)
+    process.observeCall("vehicle/makes", 200, 0.3)
+    with batch.valuing("threads"):
+        pass
+
+    summary = batch.getSummary()
+    assert list(summary["kbbCalls"]) == ["vehicle/values"]
+    values = summary["kbbCalls"]["vehicle/values"]
+    assert (values["calls"], values["retries"], values["throttled"], values["errors"]) == (2, 1, 1, 0)
+    assert values["latency"]["max"] == 0.04
+    assert summary["vehicleSeconds"]["threads"]["count"] == 1
+
+    text = process.render()
+    assert 'kbb_request_duration_seconds_bucket{endpoint="vehicle/values",status="429",le="0.025"} 1' in text
+    assert 'kbb_request_duration_seconds_bucket{endpoint="vehicle/values",status="200",le="+Inf"} 1' in text
+    assert 'kbb_request_duration_seconds_count{endpoint="vehicle/makes",status="200"} 1' in text
+    assert 'kbb_retries_total{endpoint="vehicle/values",status="429"} 1' in text
+    assert 'kbb_throttled_total{endpoint="vehicle/values"} 1' in text
+    assert 'kbb_vehicles_in_progress{engine="threads"} 0' in text
+
+
+def test_metrics_endpoint(app: flask.app.Flask, client: FlaskClient) -> None:
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.mimetype == "text/plain"
+    text = res.data.decode()
+    for name in ("kbb_request_duration_seconds", "kbb_queued_vehicles", "kbb_worker_utilization", "kbb_cache_hit_ratio"):
+        assert "# TYPE " + name + " " in text
+    for line in text.splitlines():
+        assert line.startswith("#") or len(line.rsplit(" ", 1)) == 2
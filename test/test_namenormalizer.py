@@ -0,0 +1,77 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from typing import List
+
+from kbb import Kbb
+
+WORDS = ["PKUP", "pkup", "Ltd", "LTD", "4x4", "4X4", "SR5", "Edition", "EDITION", "TRD", "Off", "Road", "w/",
+         "Package", "PACKAGE", "Moonroof", "Power", "Navi", "&", "JBL", "(Premium)", "Wheel", "Locks", "Fixed",
+         "Delete", "Blind", "Spot", "A-6'", "Tacoma", "Audio,", "deleted", "Straße", "l4", "Limited"]
+
+
+def convertTrimName(trimName: str) -> str:
+    """The trim conversion as it was before the tables were compiled, kept to check against"""
+    convertedTrimName = []
+    for trimWord in trimName.split():
+        if trimWord.upper() in Kbb.TRIM_IGNORE:
+            break
+        for acro, word in Kbb.TRIM_CONVERSION.items():
+            if acro.upper() == trimWord.upper():
+                trimWord = word
+                break
+        convertedTrimName.append(trimWord)
+    return ' '.join(convertedTrimName)
+
+
+def convertOptionName(optionName: str) -> str:
+    convertedOptionName = []
+    match = False
+    for word in optionName.split():
+        for replace, replacement in Kbb.OPTION_CONVERSION.items():
+            if replace.upper() == word.upper():
+                convertedOptionName.append(replacement.upper())
+                match = True
+                break
+        if not match:
+            convertedOptionName.append(word)
+    return " ".join(convertedOptionName)
+
+
+def filterOptions(options: List[str]) -> List[str]:
+    for blacklist in Kbb.OPTION_IGNORE:
+        options = [option for option in options if not blacklist.upper() in option.upper()]
+    return options
+
+
+def cleanName(name: str) -> str:
+    for substr in Kbb.OPTION_REMOVE:
+        name = name.replace(substr, "")
+    return name
+
+
+def test_compiled_names_match_linear_conversions() -> None:
+    corpus = random.Random(18)
+    kbb = Kbb("key")
+    for name in range(2000):
+        words = [corpus.choice(WORDS) for word in range(corpus.randint(0, 6))]
+        name = corpus.choice([" ", "  ", " "]).join(words)
+        options = [" ".join(corpus.sample(WORDS, 2)) for option in range(corpus.randint(0, 4))]
+
+        assert kbb.convertServcoTrimName(name) == convertTrimName(name)
+        assert kbb.convertServcoOptionName(name) == convertOptionName(name)
+        assert kbb.filterServcoOptions(options) == filterOptions(options)
+        assert kbb.cleanOptionNames([name]) == [cleanName(name)]
+    assert Kbb.names.getStats()["hits"] > 0
@@ -0,0 +1,73 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from typing import Dict, List
+
+from kbb import Kbb
+from optionindex import OptionIndex
+
+WORDS = ["Moon", "Roof", "JBL", "Audio", "Navigation", "System", "Premium", "Pkg", "Blind-Spot", "Monitor",
+         "Towing", "Sonar", "4WD", "V6", "Leather", "Seats", "Heated", "Alloy", "Wheels", "Sport", "Entune",
+         "moon", "AUDIO", "Off-Road", "TRD", "Bed", "Liner", "Package,"]
+
+
+def linearMatch(options: List[str], kbbOptions: List[Dict]) -> List[Dict]:
+    """The matcher as it was before the index, kept to check the index against"""
+    matchedOptions = []
+    KBBVehicleOptions = kbbOptions
+    for option in options:
+        matchCount = 0
+        for optionWord in option.split():
+            savedOptions = KBBVehicleOptions
+            KBBVehicleOptions = list(filter(lambda x: (optionWord.upper() in x["optionName"].replace(",", "").upper().split()), KBBVehicleOptions))
+            if len(KBBVehicleOptions) == 1:
+                matchCount += 1
+                if (optionWord.upper() in (x.upper() for x in Kbb.BYPASS_OPTIONS)
+                or optionWord.upper() in (x.upper() for x in Kbb.OPTIONS_IN_TRIM)
+                or matchCount/len(KBBVehicleOptions[0]["optionName"].split()) > Kbb.OPTION_MATCH_PERCENTAGE):
+                    matchedOptions.append(KBBVehicleOptions[0])
+                    break
+            elif len(KBBVehicleOptions) > 0:
+                matchCount += 1
+            elif len(KBBVehicleOptions) == 0:
+                KBBVehicleOptions = savedOptions
+        KBBVehicleOptions = kbbOptions
+    return matchedOptions
+
+
+def test_index_matches_linear_matcher() -> None:
+    corpus = random.Random(17)
+    bypassWords = {word.upper() for word in Kbb.BYPASS_OPTIONS + Kbb.OPTIONS_IN_TRIM}
+    for vehicle in range(500):
+        kbbOptions = [{"vehicleOptionId": i, "optionName": " ".join(corpus.sample(WORDS, corpus.randint(1, 4)))}
+                      for i in range(corpus.randint(1, 30))]
+        options = [" ".join(corpus.choice(WORDS) for word in range(corpus.randint(0, 5))) for option in range(corpus.randint(0, 8))]
+
+        index = OptionIndex([option["optionName"] for option in kbbOptions])
+        matches = index.match(options, bypassWords, Kbb.OPTION_MATCH_PERCENTAGE)
+
+        assert [kbbOptions[match] for match in matches if match is not None] == linearMatch(options, kbbOptions)
+
+
+def test_vehicles_share_an_index() -> None:
+    kbb = Kbb("key")
+    kbb.vehicle = {"vehicleId": 42, "vehicleOptions": [{"vehicleOptionId": 1, "optionName": "Moon Roof"},
+                                                       {"vehicleOptionId": 2, "optionName": "JBL Audio (Premium)"}]}
+    misses = Kbb.optionIndexCache.getStats()["misses"]
+
+    assert [option["vehicleOptionId"] for option in kbb.getMatchingVehicleOptionCodes(["JBL Audio"])] == [2]
+    kbb.vehicle["vehicleOptions"] = [dict(option) for option in kbb.vehicle["vehicleOptions"]]
+    assert [option["vehicleOptionId"] for option in kbb.getMatchingVehicleOptionCodes(["Moonroof"])] == [1]
+    assert Kbb.optionIndexCache.getStats()["misses"] == misses + 1
@@ -0,0 +1,51 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from ratelimiter import RateLimiter
+
+
+def test_burst_then_paced() -> None:
+    limiter = RateLimiter(rate=10, burst=2)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.1, abs=0.01)
+    assert limiter.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_throttled_pauses_everyone_and_slows_down() -> None:
+    limiter = RateLimiter(rate=10, burst=10)
+    limiter.update(429, {"Retry-After": "2"})
+    assert limiter.reserve() == pytest.approx(2, abs=0.01)
+    assert limiter.getStats()["rate"] == 5
+    assert limiter.getStats()["throttled"] == 1
+
+    limiter.update(200, {})
+    assert limiter.getStats()["rate"] == 5.1
+
+
+def test_learns_limit_from_headers() -> None:
+    limiter = RateLimiter(rate=10, burst=10)
+    limiter.update(200, {"X-RateLimit-Limit-Second": "4", "X-RateLimit-Remaining-Second": "3"})
+    assert limiter.getStats()["maxRate"] == 4
+    assert limiter.getStats()["burst"] == 4
+
+
+def test_header_limit_never_raises_the_configured_rate() -> None:
+    limiter = RateLimiter(rate=2, burst=2)
+    for i in range(100):
+        limiter.update(200, {"X-RateLimit-Limit-Second": "10"})
+    assert limiter.getStats()["maxRate"] == 2
+    assert limiter.getStats()["rate"] == 2
@@ -0,0 +1,49 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pathlib
+from typing import Callable
+
+import pytest
+
+from fakekbb import FakeKbb
+from kbb import Kbb
+from resolutionstore import ResolutionStore
+
+VEHICLES = [("1", "5TFCZ5AN1KX000001", 2019, "Toyota", "Tacoma", "Tacoma SR5", 40000, "96819", ["Moonroof"]),
+            ("2", "", 2019, "Toyota", "Tacoma", "Tacoma SR5 Double Cab", 52000, "96819", ["JBL Audio"])]
+
+
+def test_stored_vehicles_are_only_priced(fake: FakeKbb, clearCaches: Callable[[], None], monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    path = str(tmp_path / "resolutions.sqlite3")
+    monkeypatch.setattr(Kbb, "resolutionStore", ResolutionStore(path))
+    first = [Kbb("key").getVehicleValue(*vehicle) for vehicle in VEHICLES]
+
+    #A new process with cold caches reads the resolutions back from disk
+    clearCaches()
+    monkeypatch.setattr(Kbb, "resolutionStore", ResolutionStore(path))
+    calls = sum(fake.getStats()["calls"].values())
+    again = [Kbb("key").getVehicleValue(*vehicle) for vehicle in VEHICLES]
+    assert sum(fake.getStats()["calls"].values()) - calls == len(VEHICLES)
+    assert [value["numCallsMade"] for value in again] == [1, 1]
+    assert [value["resolvedFromStore"] for value in again] == [True, True]
+    assert [value["prices"] for value in again] == [value["prices"] for value in first]
+
+    #Changed inputs or forceResolve resolve the vehicle again
+    changed = Kbb("key").getVehicleValue(*VEHICLES[0][:8], ["Moonroof", "Navi System"])
+    forced = Kbb("key")
+    forced.forceResolve = True
+    assert not changed["resolvedFromStore"]
+    assert not forced.getVehicleValue(*VEHICLES[1])["resolvedFromStore"]
+    assert Kbb.resolutionStore.getStats()["saved"] == 2
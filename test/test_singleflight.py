@@ -0,0 +1,62 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_call() -> None:
+    flights = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def call() -> str:
+        calls.append(1)
+        release.wait()
+        return "models"
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(flights.do, "key", "vehicle/models", call) for i in range(5)]
+        while flights.getStats()["saved"] < 4:
+            pass
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert sorted(shared for result, shared in results) == [False, True, True, True, True]
+    assert flights.getStats() == {"saved": 4, "byEndpoint": {"vehicle/models": 4}}
+    assert flights.do("key", "vehicle/models", lambda: "again") == ("again", False)
+
+
+def test_coroutines_share_failures() -> None:
+    flights = SingleFlight()
+
+    async def call() -> str:
+        await asyncio.sleep(0.01)
+        raise ValueError("The KBB API responded with a 500 status code")
+
+    async def run() -> list:
+        return await asyncio.gather(*(flights.doAsync("key", "vehicle/values", call) for i in range(3)), return_exceptions=True)
+
+    errors = asyncio.run(run())
+
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert flights.getStats()["saved"] == 2
+    with pytest.raises(ValueError):
+        asyncio.run(flights.doAsync("key", "vehicle/values", call))
@@ -0,0 +1,72 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+
+from batchjob import BatchJob
+from vehicledatareader import VehicleDataReader
+
+CSV = """ID,VIN,Year,MakeName,ModelName,BodyStyle,OptionsDescription,Mileage
+1,VIN1,2019,Toyota,Tacoma,SR5 PKUP,Moonroof,"40,000"
+1,VIN1,2019,Toyota,Tacoma,SR5 PKUP,JBL Audio,"40,000"
+2,VIN2,2019,Toyota,Tacoma,SR5 PKUP,Navi System,"12,345"
+3,VIN3,2019,Toyota,Tacoma,SR5 PKUP,,
+"""
+
+
+def test_csv_stream_matches_csv_input() -> None:
+    vehicles = VehicleDataReader(3).csvInput(CSV)
+    streamed = dict(VehicleDataReader(3).csvStream(io.StringIO(CSV), window=1))
+
+    assert streamed == vehicles
+    assert vehicles["VIN1"]["options"] == ["Moonroof", "JBL Audio"]
+    assert vehicles["VIN3"]["key"] == "VIN3"
+    assert "errors" in vehicles["VIN3"]
+
+
+def test_csv_stream_yields_before_the_end() -> None:
+    stream = VehicleDataReader(3).csvStream(io.StringIO(CSV), window=1)
+
+    key, vehicle = next(stream)
+
+    assert key == "VIN1"
+    assert vehicle["options"] == ["Moonroof", "JBL Audio"]
+
+
+def test_fast_validation_matches_pydantic() -> None:
+    for validation in (1, 2, 3, 4):
+        fast = VehicleDataReader(validation).csvInput(CSV)
+        slow = VehicleDataReader(validation, fastValidation=False).csvInput(CSV)
+        assert [list(vehicle.items()) for vehicle in fast.values()] == [list(vehicle.items()) for vehicle in slow.values()]
+
+
+def test_fast_validation_leaves_odd_rows_to_pydantic() -> None:
+    reader = VehicleDataReader(3)
+    row = {"key": "1", "vin": "VIN1", "year": " 2019", "make": "Toyota", "model": "Tacoma", "trim": "Tacoma SR5", "mileage": 40000}
+
+    assert reader.checkVehicle(row) is None
+    assert reader.makeVehicle(row)["year"] == 2019
+
+
+def test_csv_stream_warns_about_option_rows_past_the_window() -> None:
+    late = CSV + '1,VIN1,2019,Toyota,Tacoma,SR5 PKUP,Tow Package,"40,000"\n'
+    reader = VehicleDataReader(3)
+    batch = BatchJob(reader.csvStream(io.StringIO(late), window=1), reader=reader)
+    while batch.nextRecord() is not None:
+        pass
+    batch.warnLateOptions()
+
+    assert batch.records["VIN1"]["options"] == ["Moonroof", "JBL Audio"]
+    assert "Tow Package" in batch.records["VIN1"]["warnings"][0]
+    assert batch.getSummary()["droppedOptionRows"] == 1
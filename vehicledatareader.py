@@ -1,5 +1,6 @@
 import io
 import csv
+from collections import OrderedDict
 from typing import List
 from pydantic import BaseModel, ValidationError, validator, root_validator
 
@@ -72,15 +73,92 @@ class VehicleDataReader:
     CSV_TRIM_COLUMN = "BodyStyle"
     CSV_OPTION_COLUMN = "OptionsDescription"
     CSV_MILEAGE_COLUMN = "Mileage"
+    CSV_WINDOW = 256 #Vehicles held back by csvStream waiting for more option rows
 
 
-    def __init__(self, validation=None, limit=float("inf")) -> None:
+    def __init__(self, validation=None, limit=float("inf"), fastValidation=True) -> None:
         self.vehicleData = {}
         self.validation = validation
         self.limit = limit
+        self.fastValidation = fastValidation #Check plainly valid rows without building a pydantic Vehicle
+        self.lateOptions = {} #key -> option rows csvStream dropped because they came after the vehicle was yielded
+        self.droppedOptionRows = 0
+
+    def makeVehicle(self, fields):
+        #Returns the vehicle dict for a row, raising the pydantic ValidationError if it isn't valid
+        vehicle = self.checkVehicle(fields) if self.fastValidation else None
+        if vehicle is None:
+            vehicle = Vehicle(**fields).__dict__
+        return vehicle
+
+    def checkVehicle(self, fields):
+        #Builds the same dict as Vehicle(**fields).__dict__ for a row that is plainly valid. Returns None
+        #for anything else so pydantic can coerce it or report the error in its own words.
+        key = fields.get(self.ID)
+        vin = fields.get(self.VIN, "")
+        year = fields.get(self.YEAR)
+        make = fields.get(self.MAKE)
+        model = fields.get(self.MODEL)
+        trim = fields.get(self.TRIM)
+        mileage = fields.get(self.MILEAGE)
+        zip = fields.get(self.ZIP)
+        options = fields.get(self.OPTIONS, [])
+        validation = fields.get(self.VALIDATION, 3)
+
+        if type(key) is not str or type(vin) is not str or type(make) is not str or type(model) is not str:
+            return None
+        if not make or not model:
+            return None
+        if type(year) is str and year.isascii() and year.isdigit():
+            year = int(year)
+        elif type(year) is not int:
+            return None
+        if type(mileage) is str and mileage.isascii() and mileage.isdigit():
+            mileage = int(mileage)
+        elif mileage is not None and type(mileage) is not int:
+            return None
+        if (trim is not None and type(trim) is not str) or (zip is not None and type(zip) is not str):
+            return None
+        if type(options) is not list or not all(type(option) is str for option in options):
+            return None
+
+        if validation == 1:
+            valid = vin or (year and make and model)
+        elif validation == 2:
+            valid = vin and year and make and model and mileage
+        elif validation == 3:
+            valid = vin and year and make and model and mileage and trim
+        elif validation == 4:
+            valid = vin and year and make and model and mileage and trim and len(options) > 0
+        else:
+            return None
+        if not valid or type(validation) is not int:
+            return None
+
+        return {self.ID: key,
+                self.VIN: vin,
+                self.YEAR: year,
+                self.MAKE: make,
+                self.MODEL: model,
+                self.TRIM: trim,
+                self.MILEAGE: mileage,
+                self.ZIP: zip,
+                self.OPTIONS: list(options),
+                self.VALIDATION: validation}
 
     def csvInput(self, csvData):
-        csvReader = csv.DictReader(io.StringIO(csvData))
+        for key, vehicle in self.csvStream(io.StringIO(csvData), window=float("inf")):
+            self.vehicleData[key] = vehicle
+        return self.vehicleData
+
+    def csvStream(self, csvFile, window=CSV_WINDOW):
+        #Reads a text stream a row at a time and yields (key, vehicle) pairs. A vehicle is held back
+        #until window newer vehicles have started, so option rows that follow it are still added.
+        #Option rows that turn up after their vehicle was yielded can't be added, they are counted in
+        #droppedOptionRows and kept by key in lateOptions so the vehicle can be warned about them.
+        csvReader = csv.DictReader(csvFile)
+        pending = OrderedDict()
+        done = set()
         count = 0
         for row in csvReader:
             if float(count) == self.limit:
@@ -105,12 +183,17 @@ class VehicleDataReader:
             
             key = vin if vin else str(id)
 
-            if key not in self.vehicleData:
+            if key in done:
+                if option:
+                    self.droppedOptionRows += 1
+                    self.lateOptions.setdefault(key, []).append(option)
+                continue
+            if key not in pending:
                 options = list()
                 if option:
                     options.append(option)
                 try:
-                    vehicle = Vehicle(**{self.ID: key,
+                    vehicle = self.makeVehicle({self.ID: key,
                            self.VIN: vin, 
                            self.YEAR: year, 
                            self.MAKE: make, 
@@ -119,9 +202,9 @@ class VehicleDataReader:
                            self.MILEAGE: mileage, 
                            self.OPTIONS: options,
                            self.VALIDATION: self.validation
-                           }).__dict__
+                           })
                 except Exception as e:
-                    vehicle = {self.ID: id,
+                    vehicle = {self.ID: key,
                            self.VIN: vin, 
                            self.YEAR: year, 
                            self.MAKE: make, 
@@ -132,18 +215,18 @@ class VehicleDataReader:
                            self.VALIDATION: self.validation,
                            self.ERRORS: str(e)
                            }
-                self.vehicleData[key] = vehicle
+                if len(pending) >= window:
+                    oldest = pending.popitem(last=False)
+                    done.add(oldest[0])
+                    yield oldest
+                pending[key] = vehicle
                 count += 1
             else:
                 if option:
-                    if isinstance(self.vehicleData[key], Vehicle):
-                        options = getattr(self.vehicleData[key], self.OPTIONS)
-                        options = list(set(options.append(option)))
-                        setattr(self.vehicleData[key], self.OPTIONS, options)
-                    else:
-                        self.vehicleData[key][self.OPTIONS].append(option)
+                    pending[key][self.OPTIONS].append(option)
 
-        return self.vehicleData
+        while pending:
+            yield pending.popitem(last=False)
 
     def jsonInput(self, jsonData):
         count = 0
@@ -157,7 +240,7 @@ class VehicleDataReader:
             row[self.ID] = key
             row[self.VALIDATION] = self.validation
             try:
-                self.vehicleData[key] = Vehicle(**row).__dict__
+                self.vehicleData[key] = self.makeVehicle(row)
             except Exception as e:
                 row[self.ERRORS] = str(e)
                 self.vehicleData[key] = row